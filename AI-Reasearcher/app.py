@@ -1,12 +1,33 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, g, has_app_context, request, jsonify, send_from_directory
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
+import asyncio
 import os
+import hashlib
 import json
+import math
+import multiprocessing
+import queue
+import random
+import re
+import shutil
 import sqlite3
-from datetime import datetime
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from types import SimpleNamespace
 import PyPDF2
-from anthropic import Anthropic
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+import anthropic
+from anthropic import Anthropic, AsyncAnthropic
 
 app = Flask(__name__)
 CORS(app)
@@ -19,17 +40,299 @@ ALLOWED_EXTENSIONS = {'pdf', 'txt'}
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+# Background ingestion (extraction + analysis) runs on a bounded worker pool
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 4))
+INGEST_QUEUE_LIMIT = int(os.environ.get('INGEST_QUEUE_LIMIT', 100))
+MAX_TRACKED_JOBS = 1000
+# Idle job event streams send a keep-alive comment this often
+JOB_EVENTS_KEEPALIVE_SECONDS = 15
+
+# Extraction runs in separate worker processes
+EXTRACT_PROCESSES = int(os.environ.get('EXTRACT_PROCESSES', os.cpu_count() or 1))
+
+# All AI calls share one concurrency cap and requests/tokens-per-minute budget; excess callers wait in line
+ANALYSIS_CONCURRENCY = int(os.environ.get('ANALYSIS_CONCURRENCY', 4))
+ANALYSIS_REQUESTS_PER_MINUTE = int(os.environ.get('ANALYSIS_REQUESTS_PER_MINUTE', 50))
+ANALYSIS_TOKENS_PER_MINUTE = int(os.environ.get('ANALYSIS_TOKENS_PER_MINUTE', 40000))
+ANALYSIS_RATE_LIMIT_RETRIES = 5
+
+# Transient model errors (timeouts, connection failures, 5xx) are retried with jittered exponential backoff;
+# after ANALYSIS_CIRCUIT_THRESHOLD consecutive failures calls fail fast until a probe succeeds
+ANALYSIS_TIMEOUT = float(os.environ.get('ANALYSIS_TIMEOUT', 60))
+ANALYSIS_MAX_RETRIES = int(os.environ.get('ANALYSIS_MAX_RETRIES', 3))
+ANALYSIS_BACKOFF_BASE = 1.0
+ANALYSIS_BACKOFF_MAX = 30.0
+ANALYSIS_CIRCUIT_THRESHOLD = int(os.environ.get('ANALYSIS_CIRCUIT_THRESHOLD', 5))
+ANALYSIS_CIRCUIT_RESET_SECONDS = float(os.environ.get('ANALYSIS_CIRCUIT_RESET_SECONDS', 60))
+
+# Limits applied to each extraction worker; offenders are killed and reported
+EXTRACT_TIMEOUT = float(os.environ.get('EXTRACT_TIMEOUT', 120))
+EXTRACT_MAX_RSS_MB = int(os.environ.get('EXTRACT_MAX_RSS_MB', 1024))
+# Hard address space limit set inside the worker, so an allocation burst fails before the host runs out of memory;
+# mapped libraries count here but not in RSS, so it sits above EXTRACT_MAX_RSS_MB
+EXTRACT_MAX_ADDRESS_SPACE_MB = int(os.environ.get('EXTRACT_MAX_ADDRESS_SPACE_MB', 2 * EXTRACT_MAX_RSS_MB))
+MAX_PDF_PAGES = int(os.environ.get('MAX_PDF_PAGES', 5000))
+
+# PDFs with at least this many pages are split into page ranges and extracted in parallel
+PARALLEL_EXTRACT_MIN_PAGES = int(os.environ.get('PARALLEL_EXTRACT_MIN_PAGES', 64))
+MIN_PAGES_PER_TASK = 16
+
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Text is stored per page; plain text files are split into pages of this many characters
+TEXT_PAGE_CHARS = 4000
+MAX_PAGES_PER_REQUEST = 50
+
+# Extracted text is cached on disk by file hash; bump EXTRACTOR_VERSION whenever extraction output changes
+EXTRACTOR_VERSION = f'pypdf2-{PyPDF2.__version__}-pages-1'
+EXTRACTION_CACHE_FOLDER = os.environ.get('EXTRACTION_CACHE_FOLDER', 'extraction_cache')
+EXTRACTION_CACHE_MAX_BYTES = int(os.environ.get('EXTRACTION_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+
+# AI analysis settings; bump ANALYSIS_PROMPT_VERSION whenever the prompt changes
+ANALYSIS_MODEL = "claude-sonnet-4-20250514"
+ANALYSIS_PROMPT_VERSION = 2
+# USD per million tokens, for the per-call cost accounting; cache writes cost 1.25x and cache reads 0.1x the
+# input price, and batch submissions half of everything
+ANALYSIS_PRICES = {
+    'claude-sonnet-4-20250514': {'input': 3.00, 'output': 15.00}
+}
+CACHE_WRITE_PRICE_FACTOR = 1.25
+CACHE_READ_PRICE_FACTOR = 0.1
+BATCH_PRICE_FACTOR = 0.5
+
+# Token budget for the text of a single analysis call; longer documents are sampled section by section.
+# 'estimate' assumes CHARS_PER_TOKEN; 'api' also measures prompts whose estimate is within
+# ANALYSIS_TOKEN_COUNT_MARGIN of the budget with the token counting endpoint (one extra, rate-limited request)
+ANALYSIS_INPUT_TOKENS = int(os.environ.get('ANALYSIS_INPUT_TOKENS', 1250))
+ANALYSIS_TOKEN_COUNTING = os.environ.get('ANALYSIS_TOKEN_COUNTING', 'estimate')
+ANALYSIS_TOKEN_COUNT_MARGIN = 0.8
+ANALYSIS_PROMPT_OVERHEAD_TOKENS = 300
+
+# 'sample' sends the most informative sections that fit in ANALYSIS_INPUT_TOKENS; 'map_reduce' (opt-in, several
+# times the tokens per document) analyzes long documents chunk by chunk in parallel and merges the results.
+# A document's map phase is capped at half of ANALYSIS_TOKENS_PER_MINUTE so it never waits on its own budget.
+ANALYSIS_MODE = os.environ.get('ANALYSIS_MODE', 'sample')
+ANALYSIS_CHUNK_TOKENS = int(os.environ.get('ANALYSIS_CHUNK_TOKENS', 2000))
+ANALYSIS_MAX_CHUNKS = int(os.environ.get('ANALYSIS_MAX_CHUNKS', 6))
+ANALYSIS_MAX_OUTPUT_TOKENS = 1000
+CHARS_PER_TOKEN = 4
+
+# Analysis results are cached by input hash; entries expire after a TTL and the least recently used are evicted
+ANALYSIS_CACHE_TTL_DAYS = float(os.environ.get('ANALYSIS_CACHE_TTL_DAYS', 30))
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.environ.get('ANALYSIS_CACHE_MAX_ENTRIES', 20000))
+ANALYSIS_MEMORY_CACHE_SIZE = 1024
+
+# Bulk reanalysis goes through the Message Batches API ('anthropic') or an in-process stand-in ('local')
+ANALYSIS_BATCH_BACKEND = os.environ.get('ANALYSIS_BATCH_BACKEND', 'anthropic')
+REANALYSIS_DOCS_PER_BATCH = int(os.environ.get('REANALYSIS_DOCS_PER_BATCH', 500))
+REANALYSIS_POLL_SECONDS = float(os.environ.get('REANALYSIS_POLL_SECONDS', 30))
+
+# Analyzer backend: 'claude', 'local' (TF-IDF keywords and an extractive summary, no API calls) or 'auto'
+# ('claude' when an API key is set, falling back to 'local' when the call fails)
+ANALYZER_BACKEND = os.environ.get('ANALYZER_BACKEND', 'auto')
+LOCAL_KEYWORDS = 8
+LOCAL_ENTITIES = 8
+LOCAL_SUMMARY_SENTENCES = 3
+LOCAL_MAX_SENTENCES = 150
+
+# SQLite connection tuning, applied to every connection (connections run in WAL mode so readers never wait on
+# the writer)
+SQLITE_CACHE_KB = int(os.environ.get('SQLITE_CACHE_KB', 64 * 1024))
+SQLITE_MMAP_BYTES = int(os.environ.get('SQLITE_MMAP_BYTES', 256 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+
+# Document text is stored once, as zlib-compressed pages, away from the metadata rows that lists scan
+CONTENT_COMPRESSION_LEVEL = 6
+
+# All writes go through one writer thread; writes queued within this window of each other share a transaction
+WRITE_BATCH_WINDOW_MS = float(os.environ.get('WRITE_BATCH_WINDOW_MS', 2))
+WRITE_BATCH_MAX = 200
+
+# Resumable chunked uploads bypass the 16MB request limit for large documents
+PARTIAL_UPLOAD_FOLDER = os.path.join(UPLOAD_FOLDER, '.partial')
+MAX_CHUNKED_UPLOAD_SIZE = int(os.environ.get('MAX_CHUNKED_UPLOAD_SIZE', 1024 * 1024 * 1024))
+# Sessions idle for longer are deleted; at most MAX_CHUNKED_UPLOADS may be open at once
+CHUNKED_UPLOAD_TTL_HOURS = float(os.environ.get('CHUNKED_UPLOAD_TTL_HOURS', 24))
+MAX_CHUNKED_UPLOADS = int(os.environ.get('MAX_CHUNKED_UPLOADS', 100))
+
 # Create uploads directory if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(PARTIAL_UPLOAD_FOLDER, exist_ok=True)
 
 # Initialize Anthropic client (set your API key as environment variable)
 client = Anthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"))
 
-def init_db():
-    """Initialize the SQLite database"""
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
+ingest_executor = ThreadPoolExecutor(max_workers=INGEST_WORKERS, thread_name_prefix='ingest')
+ingest_slots = threading.BoundedSemaphore(INGEST_QUEUE_LIMIT)
+jobs = {}
+jobs_lock = threading.RLock()
+job_events = {}
+jobs_changed = threading.Condition(jobs_lock)
+extraction_slots = threading.BoundedSemaphore(EXTRACT_PROCESSES)
+# Workers start from a clean server process rather than forking this one, whose threads may hold locks
+extraction_context = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+if extraction_context.get_start_method() == 'forkserver':
+    # The server imports the heavy dependencies once, so workers do not each pay for importing them (a script run
+    # as __main__ is still re-run in every worker)
+    extraction_context.set_forkserver_preload([__name__, 'anthropic', 'flask', 'flask_cors', 'PyPDF2'])
+chunked_uploads = {}
+chunked_uploads_lock = threading.Lock()
+extraction_cache_bytes = None
+extraction_cache_lock = threading.Lock()
+analysis_service = None
+analysis_service_lock = threading.Lock()
+local_batches = None
+requeue_lock = threading.Lock()
+requeue_job_id = None
+# Documents in a running reanalysis job, with how many such jobs hold each (guarded by jobs_lock)
+reanalyzing_doc_ids = Counter()
+analysis_memory_cache = OrderedDict()
+analysis_cache_lock = threading.Lock()
+analysis_cache_writes = 0
+analysis_call_log = threading.local()
+db_local = threading.local()
+
+def connect_db(database=None):
+    """Open a new connection with the WAL journal and tuned pragmas"""
+    conn = sqlite3.connect(database or DATABASE, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA cache_size = -{SQLITE_CACHE_KB}')
+    conn.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_BYTES}')
+    conn.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    conn.execute('PRAGMA foreign_keys = ON')
+    return conn
+
+def get_db():
+    """The shared read connection of the current request, or of the current thread outside requests
+    
+    Request connections are closed on app context teardown; worker threads keep theirs for as long as they run.
+    Writes do not go through these connections but through db_writer.
+    """
+    if has_app_context():
+        if 'db' not in g:
+            g.db = connect_db()
+        return g.db
+    
+    # Reconnect if DATABASE was repointed (the importer and benchmarks do this)
+    if getattr(db_local, 'database', None) != DATABASE:
+        if getattr(db_local, 'conn', None) is not None:
+            db_local.conn.close()
+        db_local.conn = connect_db()
+        db_local.database = DATABASE
+    return db_local.conn
+
+@app.teardown_appcontext
+def close_db(exception):
+    """Close the request's connection; anything left uncommitted is rolled back"""
+    conn = g.pop('db', None)
+    if conn is not None:
+        conn.close()
+
+class DatabaseWriter:
+    """The one thread that writes to the database
     
+    Mutations from any thread are queued as functions of a cursor. The writer takes whatever arrives within
+    WRITE_BATCH_WINDOW_MS of the first and runs it in one transaction, each function under its own savepoint so a
+    failing write is rolled back alone. Callers get their function's result, or its exception, once committed.
+    """
+    
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.conn = None
+        self.database = None
+        self.transactions = 0
+        self.writes = 0
+    
+    def submit(self, func, *args):
+        """Queue func(cursor, *args) for the next group commit; returns a Future of its result"""
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop, name='db-writer', daemon=True)
+                self.thread.start()
+        future = Future()
+        self.queue.put((func, args, future))
+        return future
+    
+    def run(self, func, *args):
+        """Run func(cursor, *args) on the writer and wait until it is committed; returns its result"""
+        if threading.current_thread() is self.thread:
+            # Called from inside a queued write: run as part of it
+            return func(self.conn.cursor(), *args)
+        return self.submit(func, *args).result()
+    
+    def connect(self):
+        """The writer's connection, reopened if DATABASE was repointed"""
+        if self.database != DATABASE:
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = connect_db()
+            self.conn.isolation_level = None  # transactions are issued explicitly
+            self.database = DATABASE
+        return self.conn
+    
+    def loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + WRITE_BATCH_WINDOW_MS / 1000
+            while len(batch) < WRITE_BATCH_MAX:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.commit_batch(batch)
+    
+    def commit_batch(self, batch):
+        """Run a batch of queued writes in one transaction and settle their futures"""
+        outcomes = []
+        try:
+            conn = self.connect()
+            c = conn.cursor()
+            c.execute('BEGIN IMMEDIATE')
+            for func, args, future in batch:
+                c.execute('SAVEPOINT queued_write')
+                try:
+                    outcomes.append((future, func(conn.cursor(), *args), None))
+                except Exception as e:
+                    c.execute('ROLLBACK TO queued_write')
+                    outcomes.append((future, None, e))
+                c.execute('RELEASE queued_write')
+            c.execute('COMMIT')
+        except Exception as e:
+            print(f"Error committing {len(batch)} queued writes: {e}")
+            if self.conn is not None and self.conn.in_transaction:
+                self.conn.rollback()
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        
+        self.transactions += 1
+        self.writes += len(batch)
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
+    def status(self):
+        return {'transactions': self.transactions, 'writes': self.writes, 'queued': self.queue.qsize()}
+
+db_writer = DatabaseWriter()
+
+@app.errorhandler(sqlite3.IntegrityError)
+def handle_integrity_error(e):
+    """Writes that reference a missing document fail the foreign key check"""
+    if 'FOREIGN KEY' in str(e):
+        return jsonify({'error': 'Document not found'}), 404
+    return jsonify({'error': str(e)}), 409
+
+def migrate_baseline(c):
+    """Schema as it stood before versioned migrations; idempotent, so it also adopts unversioned databases"""
     # Documents table
     c.execute('''CREATE TABLE IF NOT EXISTS documents
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -40,7 +343,21 @@ def init_db():
                   summary TEXT,
                   topic TEXT,
                   upload_date TEXT NOT NULL,
-                  file_type TEXT)''')
+                  file_type TEXT,
+                  content_hash TEXT)''')
+    
+    # Databases created before content hashing lack the column
+    c.execute('PRAGMA table_info(documents)')
+    if 'content_hash' not in [row[1] for row in c.fetchall()]:
+        c.execute('ALTER TABLE documents ADD COLUMN content_hash TEXT')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_documents_content_hash ON documents (content_hash)')
+    
+    # 'pending' marks documents whose AI analysis failed and should be retried once the provider recovers
+    c.execute('PRAGMA table_info(documents)')
+    if 'analysis_status' not in [row[1] for row in c.fetchall()]:
+        c.execute("ALTER TABLE documents ADD COLUMN analysis_status TEXT NOT NULL DEFAULT 'done'")
+        c.execute("UPDATE documents SET analysis_status = 'pending' "
+                  "WHERE summary IN ('Analysis unavailable', 'Analysis pending')")
     
     # Keywords table
     c.execute('''CREATE TABLE IF NOT EXISTS keywords
@@ -71,6 +388,66 @@ def init_db():
                   timestamp TEXT,
                   FOREIGN KEY (doc_id) REFERENCES documents (id))''')
     
+    # Pages table (per-page text, with each page's offset into the full content)
+    c.execute('''CREATE TABLE IF NOT EXISTS document_pages
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  doc_id INTEGER,
+                  page_number INTEGER,
+                  char_offset INTEGER,
+                  content TEXT,
+                  FOREIGN KEY (doc_id) REFERENCES documents (id))''')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_document_pages_doc_page ON document_pages (doc_id, page_number)')
+    
+    # Ingest metrics table (wall time, bytes and pages per pipeline stage)
+    c.execute('''CREATE TABLE IF NOT EXISTS ingest_metrics
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  doc_id INTEGER,
+                  job_id TEXT,
+                  stage TEXT NOT NULL,
+                  duration_ms REAL NOT NULL,
+                  bytes INTEGER,
+                  pages INTEGER,
+                  recorded_at TEXT NOT NULL,
+                  FOREIGN KEY (doc_id) REFERENCES documents (id))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ingest_metrics_doc_id ON ingest_metrics (doc_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ingest_metrics_recorded_at ON ingest_metrics (recorded_at)')
+    
+    # Analysis cache table (model responses keyed by a hash of their inputs)
+    c.execute('''CREATE TABLE IF NOT EXISTS analysis_cache
+                 (cache_key TEXT PRIMARY KEY,
+                  analysis TEXT NOT NULL,
+                  created_at REAL NOT NULL,
+                  last_used REAL NOT NULL)''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_analysis_cache_last_used ON analysis_cache (last_used)')
+    
+    # Analysis calls table (tokens, latency and cost of every model call)
+    c.execute('''CREATE TABLE IF NOT EXISTS analysis_calls
+                 (id INTEGER PRIMARY KEY AUTOINCREMENT,
+                  doc_id INTEGER,
+                  model TEXT NOT NULL,
+                  input_tokens INTEGER NOT NULL,
+                  output_tokens INTEGER NOT NULL,
+                  cache_creation_tokens INTEGER NOT NULL,
+                  cache_read_tokens INTEGER NOT NULL,
+                  latency_ms REAL,
+                  cost_usd REAL,
+                  batch INTEGER NOT NULL DEFAULT 0,
+                  created_at TEXT NOT NULL,
+                  FOREIGN KEY (doc_id) REFERENCES documents (id))''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_analysis_calls_created_at ON analysis_calls (created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_analysis_calls_doc_id ON analysis_calls (doc_id)')
+    
+    # Corpus term table (number of documents containing each word, for local TF-IDF keywords)
+    c.execute('''CREATE TABLE IF NOT EXISTS corpus_terms
+                 (term TEXT PRIMARY KEY,
+                  doc_count INTEGER NOT NULL)''')
+    c.execute('SELECT 1 FROM corpus_terms LIMIT 1')
+    if c.fetchone() is None:
+        # One-time backfill for databases created before the table existed
+        c.execute('SELECT content FROM documents WHERE content IS NOT NULL')
+        for (content,) in c.fetchall():
+            update_corpus_terms(c, document_terms(content), 1)
+    
     # Links table (for document relationships)
     c.execute('''CREATE TABLE IF NOT EXISTS document_links
                  (id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -78,83 +455,1704 @@ def init_db():
                   linked_doc_id INTEGER,
                   FOREIGN KEY (doc_id) REFERENCES documents (id),
                   FOREIGN KEY (linked_doc_id) REFERENCES documents (id))''')
+
+
+def migrate_document_contents(c):
+    """Compress every document body into document_contents and drop documents.content"""
+    c.execute('''CREATE TABLE IF NOT EXISTS document_contents
+                 (doc_id INTEGER PRIMARY KEY,
+                  body BLOB NOT NULL,
+                  length INTEGER NOT NULL,
+                  FOREIGN KEY (doc_id) REFERENCES documents (id))''')
+    rows = c.connection.execute('SELECT id, content FROM documents WHERE content IS NOT NULL')
+    while True:
+        batch = rows.fetchmany(500)
+        if not batch:
+            break
+        c.executemany('INSERT INTO document_contents (doc_id, body, length) VALUES (?, ?, ?)',
+                      [(doc_id, *compress_content(content)) for doc_id, content in batch])
+    c.execute('ALTER TABLE documents DROP COLUMN content')
+
+def migrate_compressed_pages(c):
+    """Compress page text and make pages the only copy of a document's text, dropping document_contents"""
+    c.execute('ALTER TABLE document_pages ADD COLUMN body BLOB')
+    c.execute('ALTER TABLE document_pages ADD COLUMN length INTEGER')
+    last_id = 0
+    while True:
+        c.execute('SELECT id, content FROM document_pages WHERE id > ? ORDER BY id LIMIT 500', (last_id,))
+        batch = c.fetchall()
+        if not batch:
+            break
+        c.executemany('UPDATE document_pages SET body = ?, length = ? WHERE id = ?',
+                      [(*compress_content(content or ''), page_id) for page_id, content in batch])
+        last_id = batch[-1][0]
+    
+    # Documents not opened since page storage was added have no pages yet
+    c.execute('''SELECT doc_id, body FROM document_contents
+                 WHERE doc_id NOT IN (SELECT doc_id FROM document_pages)''')
+    for doc_id, body in c.fetchall():
+        store_pages(c, doc_id, split_text_pages(decompress_content(body)))
+    
+    c.execute('ALTER TABLE document_pages DROP COLUMN content')
+    c.execute('DROP TABLE document_contents')
+
+# Schema migrations, applied in order; each runs in its own transaction and bumps PRAGMA user_version.
+# Never edit a released migration, append a new one instead.
+MIGRATIONS = [
+    (1, 'Baseline schema', migrate_baseline),
+    (2, 'Indexes on document foreign keys, tags, links and upload date', [
+        'CREATE INDEX IF NOT EXISTS idx_keywords_doc_id ON keywords (doc_id)',
+        'CREATE INDEX IF NOT EXISTS idx_entities_doc_id ON entities (doc_id)',
+        'CREATE INDEX IF NOT EXISTS idx_tags_doc_id ON tags (doc_id)',
+        'CREATE INDEX IF NOT EXISTS idx_tags_tag ON tags (tag)',
+        'CREATE INDEX IF NOT EXISTS idx_notes_doc_id ON notes (doc_id, timestamp)',
+        'CREATE INDEX IF NOT EXISTS idx_document_links_pair ON document_links (doc_id, linked_doc_id)',
+        'CREATE INDEX IF NOT EXISTS idx_document_links_linked_doc_id ON document_links (linked_doc_id)',
+        'CREATE INDEX IF NOT EXISTS idx_documents_upload_date ON documents (upload_date)',
+        'CREATE INDEX IF NOT EXISTS idx_documents_analysis_status ON documents (analysis_status)'
+    ]),
+    (3, 'Move document bodies into the compressed document_contents table', migrate_document_contents),
+    (4, 'Store page text compressed and drop the duplicate document_contents table', migrate_compressed_pages)
+]
+
+def init_db():
+    """Create or upgrade the SQLite database by applying any pending migrations
     
-    conn.commit()
-    conn.close()
+    Safe to run against a live database: each migration takes the write lock only for its own transaction
+    (readers carry on under WAL), and the version is rechecked under the lock so concurrent runs apply it once.
+    """
+    conn = connect_db()
+    conn.isolation_level = None  # explicit transactions, so DDL and the version bump commit together
+    c = conn.cursor()
+    try:
+        for version, description, migration in MIGRATIONS:
+            c.execute('BEGIN IMMEDIATE')
+            try:
+                c.execute('PRAGMA user_version')
+                if c.fetchone()[0] >= version:
+                    c.execute('ROLLBACK')
+                    continue
+                if callable(migration):
+                    migration(c)
+                else:
+                    for statement in migration:
+                        c.execute(statement)
+                c.execute(f'PRAGMA user_version = {version}')
+                c.execute('COMMIT')
+            except BaseException:
+                c.execute('ROLLBACK')
+                raise
+            print(f"Applied database migration {version}: {description}")
+    finally:
+        conn.close()
 
 def allowed_file(filename):
     """Check if file extension is allowed"""
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def extract_text_from_pdf(file_path):
+def build_upload_path(filename):
+    """Return a (unique_filename, file_path) pair that does not clash with an existing upload"""
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
+    unique_filename = timestamp + filename
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+    if os.path.exists(file_path):
+        unique_filename = timestamp + uuid.uuid4().hex[:8] + '_' + filename
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+    return unique_filename, file_path
+
+def save_upload(file, file_path):
+    """Stream an uploaded file to disk, returning its SHA-256 hex digest"""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'wb') as out:
+        for chunk in iter(lambda: file.stream.read(UPLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+            out.write(chunk)
+    return sha256.hexdigest()
+
+def file_sha256(file_path):
+    """Return the SHA-256 hex digest of a file on disk"""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(UPLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def extraction_cache_dir():
+    """Directory holding cache entries for the current extractor version"""
+    return os.path.join(EXTRACTION_CACHE_FOLDER, secure_filename(EXTRACTOR_VERSION))
+
+def init_extraction_cache():
+    """Drop cache entries written by other extractor versions"""
+    os.makedirs(extraction_cache_dir(), exist_ok=True)
+    current = os.path.basename(extraction_cache_dir())
+    for name in os.listdir(EXTRACTION_CACHE_FOLDER):
+        path = os.path.join(EXTRACTION_CACHE_FOLDER, name)
+        if name != current and os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+
+def get_cached_extraction(content_hash):
+    """Return cached pages for a file hash, or None on a miss"""
+    path = os.path.join(extraction_cache_dir(), content_hash + '.json')
+    try:
+        with open(path, 'r', encoding='utf-8') as cache_file:
+            pages = json.load(cache_file)
+        # Touch the entry so eviction sees it as recently used
+        os.utime(path, None)
+        return pages
+    except (OSError, ValueError):
+        return None
+
+def put_cached_extraction(content_hash, pages):
+    """Store extracted pages for a file hash and evict old entries past the size limit"""
+    global extraction_cache_bytes
+    cache_dir = extraction_cache_dir()
+    path = os.path.join(cache_dir, content_hash + '.json')
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump(pages, cache_file)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Error writing extraction cache: {e}")
+        return
+    
+    with extraction_cache_lock:
+        if extraction_cache_bytes is None:
+            entries = [entry for entry in os.scandir(cache_dir) if entry.name.endswith('.json')]
+            extraction_cache_bytes = sum(entry.stat().st_size for entry in entries)
+        else:
+            extraction_cache_bytes += os.path.getsize(path)
+        
+        if extraction_cache_bytes > EXTRACTION_CACHE_MAX_BYTES:
+            # Evict least recently used entries down to 90% of the limit
+            entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                       for entry in os.scandir(cache_dir) if entry.name.endswith('.json')]
+            entries.sort()
+            extraction_cache_bytes = sum(size for _, size, _ in entries)
+            for _, size, entry_path in entries:
+                if extraction_cache_bytes <= EXTRACTION_CACHE_MAX_BYTES * 0.9:
+                    break
+                try:
+                    os.remove(entry_path)
+                    extraction_cache_bytes -= size
+                except OSError:
+                    pass
+
+def find_duplicate(content_hash):
+    """Return (doc_id, job_id) of a stored or in-flight upload with the same content"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT id FROM documents WHERE content_hash = ? LIMIT 1', (content_hash,))
+    row = c.fetchone()
+    
+    if row:
+        return row[0], None
+    
+    # Finished jobs are not checked: a done job's document is in the table above unless it was deleted since
+    with jobs_lock:
+        for job in jobs.values():
+            if job.get('content_hash') == content_hash and job['status'] not in ('done', 'failed'):
+                return None, job['id']
+    
+    return None, None
+
+def claim_upload(filename, content_hash):
+    """Register an ingestion job unless the content is already stored or in flight
+    
+    The check and the registration happen under jobs_lock, so of two identical uploads arriving together only
+    one is processed. Returns (job_id, None, None), or (None, doc_id, job_id) of the existing upload.
+    """
+    with jobs_lock:
+        existing_doc_id, existing_job_id = find_duplicate(content_hash)
+        if existing_doc_id or existing_job_id:
+            return None, existing_doc_id, existing_job_id
+        return create_job(filename, content_hash), None, None
+
+class ExtractionError(Exception):
+    """Structured extraction failure (timeout, memory_limit, too_many_pages, crashed, unreadable, ...)"""
+    
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+        self.message = message
+    
+    def to_dict(self):
+        return {'reason': self.reason, 'message': self.message}
+
+def process_rss_bytes(pid):
+    """Resident set size of a process, or None where /proc is unavailable"""
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def sandbox_main(conn, func, args):
+    """Entry point of an extraction worker process"""
+    try:
+        if resource is not None:
+            limit = EXTRACT_MAX_ADDRESS_SPACE_MB * 1024 * 1024
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        conn.send(('ok', func(*args)))
+    except ExtractionError as e:
+        conn.send(('error', e.reason, e.message))
+    except MemoryError:
+        conn.send(('error', 'memory_limit', 'Extraction ran out of memory'))
+    except Exception as e:
+        conn.send(('error', 'unreadable', f'{type(e).__name__}: {e}'))
+    finally:
+        conn.close()
+
+def run_sandboxed(func, *args):
+    """Run func(*args) in a fresh worker process, killing it on timeout or excess memory
+    
+    The worker caps its own address space; the RSS poll here also catches growth that stays below that cap.
+    """
+    with extraction_slots:
+        parent_conn, child_conn = extraction_context.Pipe(duplex=False)
+        worker = extraction_context.Process(target=sandbox_main, args=(child_conn, func, args), daemon=True)
+        worker.start()
+        child_conn.close()
+        
+        try:
+            deadline = time.monotonic() + EXTRACT_TIMEOUT
+            while not parent_conn.poll(0.1):
+                if time.monotonic() > deadline:
+                    raise ExtractionError('timeout', f'Extraction exceeded {EXTRACT_TIMEOUT:g}s')
+                rss = process_rss_bytes(worker.pid)
+                if rss is not None and rss > EXTRACT_MAX_RSS_MB * 1024 * 1024:
+                    raise ExtractionError('memory_limit', f'Extraction exceeded {EXTRACT_MAX_RSS_MB}MB RSS')
+            
+            try:
+                outcome = parent_conn.recv()
+            except EOFError:
+                worker.join(1)
+                raise ExtractionError('crashed', f'Extraction worker exited with code {worker.exitcode}')
+        finally:
+            if worker.is_alive():
+                worker.kill()
+            worker.join()
+            parent_conn.close()
+    
+    if outcome[0] == 'error':
+        raise ExtractionError(outcome[1], outcome[2])
+    return outcome[1]
+
+def extract_pdf_page_range(file_path, start, end):
+    """Extract the text of pages [start, end) from a PDF file"""
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        return [pdf_reader.pages[i].extract_text() or '' for i in range(start, end)]
+
+def read_small_pdf(file_path):
+    """Return ('pages', texts) for small PDFs, or ('count', page_count) for ones to split"""
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        page_count = len(pdf_reader.pages)
+        
+        if page_count > MAX_PDF_PAGES:
+            raise ExtractionError('too_many_pages', f'PDF has {page_count} pages (limit {MAX_PDF_PAGES})')
+        
+        if page_count < PARALLEL_EXTRACT_MIN_PAGES or EXTRACT_PROCESSES < 2:
+            return 'pages', [page.extract_text() or '' for page in pdf_reader.pages]
+        return 'count', page_count
+
+def read_pdf_pages(file_path):
+    """Read the text of every page of a PDF in sandboxed workers, in page order"""
+    kind, result = run_sandboxed(read_small_pdf, file_path)
+    if kind == 'pages':
+        return result
+    
+    # Large PDFs are split into page ranges, each in its own worker
+    page_count = result
+    pages_per_task = max(MIN_PAGES_PER_TASK, math.ceil(page_count / (EXTRACT_PROCESSES * 2)))
+    ranges = [(start, min(start + pages_per_task, page_count))
+              for start in range(0, page_count, pages_per_task)]
+    
+    with ThreadPoolExecutor(max_workers=min(EXTRACT_PROCESSES, len(ranges))) as range_pool:
+        futures = [range_pool.submit(run_sandboxed, extract_pdf_page_range, file_path, start, end)
+                   for start, end in ranges]
+        try:
+            pages = []
+            for future in futures:
+                pages.extend(future.result())
+        except ExtractionError:
+            # One bad range fails the document; don't start the ones still queued
+            for future in futures:
+                future.cancel()
+            raise
+    return pages
+
+def extract_pdf_pages(file_path, content_hash=None):
+    """Extract the text of every page of a PDF, consulting the extraction cache first"""
+    content_hash = content_hash or file_sha256(file_path)
+    pages = get_cached_extraction(content_hash)
+    if pages is None:
+        pages = read_pdf_pages(file_path)
+        put_cached_extraction(content_hash, pages)
+    return pages
+
+def extract_text_from_pdf(file_path, content_hash=None):
     """Extract text content from PDF file"""
     try:
-        with open(file_path, 'rb') as file:
-            pdf_reader = PyPDF2.PdfReader(file)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text()
-            return text
+        return ''.join(extract_pdf_pages(file_path, content_hash))
     except Exception as e:
         print(f"Error extracting PDF text: {e}")
         return None
 
-def extract_text_from_txt(file_path):
+def extract_text_from_txt(file_path, content_hash=None):
     """Extract text content from text file"""
     try:
+        content_hash = content_hash or file_sha256(file_path)
+        pages = get_cached_extraction(content_hash)
+        if pages is not None:
+            return ''.join(pages)
+        
         with open(file_path, 'r', encoding='utf-8') as file:
-            return file.read()
+            text = file.read()
+        put_cached_extraction(content_hash, [text])
+        return text
     except Exception as e:
         print(f"Error reading text file: {e}")
         return None
 
-def analyze_document_with_ai(text, title):
-    """Use Claude API to analyze document"""
+class TokenBucket:
+    """Token bucket refilled continuously at `per_minute` tokens per minute (used on the analysis loop)"""
+    
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    async def acquire(self, amount=1):
+        """Wait until `amount` tokens are available and take them; waiters are served in order"""
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            self.refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self.refill()
+            self.tokens -= amount
+    
+    def adjust(self, amount):
+        """Charge (or refund, if negative) tokens after the fact; the balance may go negative"""
+        self.refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+    
+    def pause(self, seconds):
+        """Drain the bucket so the next single token is granted only after `seconds`"""
+        self.refill()
+        self.tokens = min(self.tokens, 1 - self.rate * seconds)
+
+class CircuitOpenError(Exception):
+    """Raised without calling the provider while the circuit breaker is open"""
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker (used on the analysis loop, so no locking)
+    
+    closed: calls go through. open: calls fail fast for `reset_seconds`. half_open: one probe call is let
+    through; success closes the circuit and runs `on_close`, failure opens it again, and a probe that ends
+    without a verdict (rate limited, cancelled) lets the next call probe instead.
+    """
+    
+    def __init__(self, threshold, reset_seconds, on_close=None):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.on_close = on_close
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+    
+    def before_call(self):
+        """Raise CircuitOpenError if the call must fail fast; returns True if the call is the half-open probe"""
+        if self.state == 'open':
+            if time.monotonic() - self.opened_at < self.reset_seconds:
+                raise CircuitOpenError('Analysis provider unavailable; circuit open')
+            self.state = 'half_open'
+        if self.state == 'half_open':
+            if self.probing:
+                raise CircuitOpenError('Analysis provider unavailable; probe in progress')
+            self.probing = True
+            return True
+        return False
+    
+    def end_probe(self):
+        """Release the probe slot; a no-op once the probe's outcome was recorded"""
+        self.probing = False
+    
+    def record_success(self):
+        reopened = self.state != 'closed'
+        self.state = 'closed'
+        self.failures = 0
+        self.probing = False
+        if reopened and self.on_close is not None:
+            self.on_close()
+    
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == 'half_open' or self.failures >= self.threshold:
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+    
+    def status(self):
+        return {'state': self.state, 'consecutive_failures': self.failures}
+
+def is_transient_error(error):
+    """Whether a model call failure is worth retrying (timeouts, connection errors, overload, 5xx)"""
+    if isinstance(error, anthropic.APIConnectionError):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in (408, 409) or error.status_code >= 500
+    return False
+
+def backoff_delay(attempt):
+    """Full-jitter exponential backoff: uniform in [0, min(max, base * 2^attempt)]"""
+    return random.uniform(0, min(ANALYSIS_BACKOFF_MAX, ANALYSIS_BACKOFF_BASE * 2 ** attempt))
+
+def request_chars(request_kwargs):
+    """Characters of input in a request (system prompt and messages)"""
+    chars = len(request_kwargs.get('system', ''))
+    return chars + sum(len(message['content']) for message in request_kwargs['messages'])
+
+def estimate_tokens(request_kwargs):
+    """Rough token cost of a request: ~4 characters per input token plus the output budget"""
+    return request_chars(request_kwargs) // 4 + request_kwargs.get('max_tokens', 0)
+
+def call_cost(model, usage, batch=False):
+    """USD cost of one call from its usage, or None for a model without a known price"""
+    prices = ANALYSIS_PRICES.get(model)
+    if prices is None:
+        return None
+    cost = (usage['input_tokens'] * prices['input']
+            + usage['cache_creation_tokens'] * prices['input'] * CACHE_WRITE_PRICE_FACTOR
+            + usage['cache_read_tokens'] * prices['input'] * CACHE_READ_PRICE_FACTOR
+            + usage['output_tokens'] * prices['output']) / 1_000_000
+    return cost * BATCH_PRICE_FACTOR if batch else cost
+
+def record_analysis_call(model, usage, latency_ms=None, batch=False, doc_id=None):
+    """Store the token counts, latency and cost of one model call; returns its id"""
+    usage = {
+        'input_tokens': getattr(usage, 'input_tokens', 0) or 0,
+        'output_tokens': getattr(usage, 'output_tokens', 0) or 0,
+        'cache_creation_tokens': getattr(usage, 'cache_creation_input_tokens', 0) or 0,
+        'cache_read_tokens': getattr(usage, 'cache_read_input_tokens', 0) or 0
+    }
+    row = (doc_id, model, usage['input_tokens'], usage['output_tokens'], usage['cache_creation_tokens'],
+           usage['cache_read_tokens'], latency_ms, call_cost(model, usage, batch), int(batch),
+           datetime.now().isoformat())
+    return db_writer.run(lambda c: c.execute('''INSERT INTO analysis_calls
+                                                (doc_id, model, input_tokens, output_tokens, cache_creation_tokens,
+                                                 cache_read_tokens, latency_ms, cost_usd, batch, created_at)
+                                                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', row).lastrowid)
+
+@contextmanager
+def track_analysis_calls():
+    """Collect the ids of the model calls this thread makes inside the block, to attribute them to a document"""
+    previous = getattr(analysis_call_log, 'ids', None)
+    analysis_call_log.ids = call_ids = []
     try:
-        # Truncate text if too long
-        text_sample = text[:5000] if len(text) > 5000 else text
+        yield call_ids
+    finally:
+        analysis_call_log.ids = previous
+
+def attribute_analysis_calls(c, doc_id, call_ids):
+    """Link recorded model calls to the document they analyzed"""
+    if call_ids:
+        c.execute(f'UPDATE analysis_calls SET doc_id = ? WHERE id IN ({",".join("?" * len(call_ids))})',
+                  [doc_id] + list(call_ids))
+
+class AnalysisService:
+    """Runs model calls on a background event loop with shared concurrency and rate limits"""
+    
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='analysis-loop', daemon=True)
+        self.thread.start()
+        # Retries are handled below so they can be classified and counted by the circuit breaker
+        self.client = AsyncAnthropic(api_key=os.environ.get("ANTHROPIC_API_KEY"), timeout=ANALYSIS_TIMEOUT,
+                                     max_retries=0)
+        self.breaker = CircuitBreaker(ANALYSIS_CIRCUIT_THRESHOLD, ANALYSIS_CIRCUIT_RESET_SECONDS,
+                                      on_close=lambda: threading.Thread(target=requeue_pending_analyses,
+                                                                        name='requeue', daemon=True).start())
+        self.slots = asyncio.Semaphore(ANALYSIS_CONCURRENCY)
+        self.request_bucket = TokenBucket(ANALYSIS_REQUESTS_PER_MINUTE)
+        self.token_bucket = TokenBucket(ANALYSIS_TOKENS_PER_MINUTE)
+        self.waiting = 0
+        self.in_flight = 0
+    
+    async def send(self, request_kwargs, on_text):
+        """One API call; with `on_text`, the response is streamed and each text delta is passed to it
         
-        message = client.messages.create(
-            model="claude-sonnet-4-20250514",
-            max_tokens=1000,
-            messages=[
-                {
-                    "role": "user",
-                    "content": f"""Analyze this research document titled "{title}".
+        If the stream fails after some text was passed on, on_text(None) tells the consumer to discard it: the
+        call may be retried, and the retry streams its output from the start.
+        """
+        if on_text is None:
+            return await self.client.messages.create(**request_kwargs)
+        streamed = False
+        try:
+            async with self.client.messages.stream(**request_kwargs) as stream:
+                async for text in stream.text_stream:
+                    streamed = True
+                    on_text(text)
+                return await stream.get_final_message()
+        except BaseException:
+            if streamed:
+                on_text(None)
+            raise
+    
+    async def count(self, request_kwargs):
+        """One token counting call for the input of a request"""
+        return await self.client.messages.count_tokens(model=request_kwargs['model'], system=request_kwargs['system'],
+                                                       messages=request_kwargs['messages'])
+    
+    async def create(self, request_kwargs, on_text=None, call_ids=None, record=True, count_only=False):
+        # Token counting calls share the request budget, slots, retries and breaker but use no model tokens
+        estimate = 0 if count_only else estimate_tokens(request_kwargs)
+        self.waiting += 1
+        rate_limited = failed = 0
+        try:
+            while True:
+                probe = self.breaker.before_call()
+                retry_delay = None
+                try:
+                    await self.request_bucket.acquire(1)
+                    await self.token_bucket.acquire(estimate)
+                    async with self.slots:
+                        self.in_flight += 1
+                        started = time.perf_counter()
+                        try:
+                            if count_only:
+                                message = await self.count(request_kwargs)
+                            else:
+                                message = await self.send(request_kwargs, on_text)
+                        except anthropic.RateLimitError as e:
+                            if rate_limited == ANALYSIS_RATE_LIMIT_RETRIES:
+                                raise
+                            rate_limited += 1
+                            # Provider says slow down: hold every caller back, then try again
+                            retry_after = float(e.response.headers.get('retry-after', 10))
+                            self.request_bucket.pause(retry_after)
+                            continue
+                        except Exception as e:
+                            if not is_transient_error(e):
+                                # The provider answered; it is the request that was refused
+                                self.breaker.record_success()
+                                raise
+                            self.breaker.record_failure()
+                            if failed == ANALYSIS_MAX_RETRIES:
+                                raise
+                            retry_delay = backoff_delay(failed)
+                            failed += 1
+                        finally:
+                            self.in_flight -= 1
+                finally:
+                    # A rate limited or cancelled probe leaves the verdict to the next call
+                    if probe:
+                        self.breaker.end_probe()
+                
+                if retry_delay is not None:
+                    # Back off without holding a concurrency slot
+                    await asyncio.sleep(retry_delay)
+                    continue
+                
+                self.breaker.record_success()
+                latency_ms = (time.perf_counter() - started) * 1000
+                usage = getattr(message, 'usage', None)
+                if usage is not None:
+                    self.token_bucket.adjust(usage.input_tokens + usage.output_tokens - estimate)
+                    if record:
+                        await self.record(request_kwargs['model'], usage, latency_ms, call_ids)
+                return message
+        finally:
+            self.waiting -= 1
+    
+    async def record(self, model, usage, latency_ms, call_ids):
+        """Account for a finished call off the event loop; failures to record never fail the call"""
+        try:
+            call_id = await self.loop.run_in_executor(None, record_analysis_call, model, usage, latency_ms)
+        except sqlite3.Error as e:
+            print(f"Error recording analysis call: {e}")
+            return
+        if call_ids is not None:
+            call_ids.append(call_id)
+    
+    def create_message(self, on_text=None, **request_kwargs):
+        """Blocking call for request threads; queues behind the shared limits instead of failing"""
+        call_ids = getattr(analysis_call_log, 'ids', None)
+        return asyncio.run_coroutine_threadsafe(self.create(request_kwargs, on_text, call_ids), self.loop).result()
+    
+    def count_tokens(self, request_kwargs):
+        """Measure the input tokens of a request with the token counting endpoint, behind the shared limits"""
+        counted = asyncio.run_coroutine_threadsafe(self.create(request_kwargs, record=False, count_only=True),
+                                                   self.loop).result()
+        return counted.input_tokens
+    
+    def create_messages(self, requests, record=True):
+        """Run several requests concurrently; failed ones come back as exceptions in the list"""
+        call_ids = getattr(analysis_call_log, 'ids', None)
+        async def gather():
+            return await asyncio.gather(*(self.create(r, call_ids=call_ids, record=record) for r in requests),
+                                        return_exceptions=True)
+        return asyncio.run_coroutine_threadsafe(gather(), self.loop).result()
+    
+    def status(self):
+        return {
+            'waiting': self.waiting,
+            'in_flight': self.in_flight,
+            'concurrency': ANALYSIS_CONCURRENCY,
+            'requests_per_minute': ANALYSIS_REQUESTS_PER_MINUTE,
+            'tokens_per_minute': ANALYSIS_TOKENS_PER_MINUTE,
+            'circuit': self.breaker.status()
+        }
+
+def get_analysis_service():
+    """Lazily start the shared analysis service"""
+    global analysis_service
+    with analysis_service_lock:
+        if analysis_service is None:
+            analysis_service = AnalysisService()
+        return analysis_service
+
+def analysis_cache_key(text_sample, title):
+    """Hash of everything that determines the model's answer"""
+    payload = json.dumps([ANALYSIS_PROMPT_VERSION, ANALYSIS_MODEL, title, text_sample])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get_cached_analysis(cache_key):
+    """Return a cached analysis, checking memory before the database"""
+    with analysis_cache_lock:
+        cached = analysis_memory_cache.get(cache_key)
+        if cached is not None:
+            analysis_memory_cache.move_to_end(cache_key)
+            return json.loads(cached)
+    
+    now = time.time()
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT analysis FROM analysis_cache WHERE cache_key = ? AND created_at >= ?',
+              (cache_key, now - ANALYSIS_CACHE_TTL_DAYS * 86400))
+    row = c.fetchone()
+    if not row:
+        return None
+    
+    # Recency only steers pruning, so the lookup does not wait for it
+    db_writer.submit(lambda c: c.execute('UPDATE analysis_cache SET last_used = ? WHERE cache_key = ?',
+                                         (now, cache_key)))
+    remember_analysis(cache_key, row[0])
+    return json.loads(row[0])
+
+def remember_analysis(cache_key, serialized):
+    """Keep a serialized analysis in the in-memory LRU"""
+    with analysis_cache_lock:
+        analysis_memory_cache[cache_key] = serialized
+        analysis_memory_cache.move_to_end(cache_key)
+        while len(analysis_memory_cache) > ANALYSIS_MEMORY_CACHE_SIZE:
+            analysis_memory_cache.popitem(last=False)
+
+def put_cached_analysis(cache_key, analysis):
+    """Store an analysis in the cache, periodically pruning expired and least recently used entries"""
+    global analysis_cache_writes
+    serialized = json.dumps(analysis)
+    remember_analysis(cache_key, serialized)
+    
+    now = time.time()
+    with analysis_cache_lock:
+        analysis_cache_writes += 1
+        prune = analysis_cache_writes % 100 == 0
+    
+    def store(c):
+        c.execute('''INSERT OR REPLACE INTO analysis_cache (cache_key, analysis, created_at, last_used)
+                     VALUES (?, ?, ?, ?)''', (cache_key, serialized, now, now))
+        if prune:
+            c.execute('DELETE FROM analysis_cache WHERE created_at < ?', (now - ANALYSIS_CACHE_TTL_DAYS * 86400,))
+            c.execute('''DELETE FROM analysis_cache WHERE cache_key IN
+                         (SELECT cache_key FROM analysis_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)''',
+                      (ANALYSIS_CACHE_MAX_ENTRIES,))
+    db_writer.run(store)
+
+# Static instructions shared by every analysis call, sent as the system prompt; anything that varies per call belongs
+# in the user message. They are well below the model's minimum cacheable prompt length, so they are not marked for
+# prompt caching: a cache_control marker on them would be ignored.
+ANALYSIS_INSTRUCTIONS = """You analyze research documents for a searchable document library.
+
+Each request gives you either the text of a document (or of one part of a long document), or the analyses of the parts of a document to merge into one.
 
-Text: {text_sample}
+When merging part analyses, pick the 5-8 most important keywords and entities, drop duplicates and near-duplicates, and order them by importance.
 
 Provide a JSON response with:
-{{
+{
   "summary": "2-3 sentence summary",
   "keywords": ["keyword1", "keyword2", "keyword3", "keyword4", "keyword5"],
   "entities": ["entity1", "entity2", "entity3"],
   "topic": "main topic category"
-}}
+}
 
 Respond ONLY with valid JSON, no other text."""
-                }
-            ]
-        )
-        
-        # Extract text from response
-        response_text = message.content[0].text
-        # Remove markdown code blocks if present
-        response_text = response_text.replace('```json', '').replace('```', '').strip()
-        
-        return json.loads(response_text)
+
+def analysis_request(content, max_tokens=ANALYSIS_MAX_OUTPUT_TOKENS):
+    """Keyword arguments for a single-message analysis call behind the static instructions"""
+    return {
+        'model': ANALYSIS_MODEL,
+        'max_tokens': max_tokens,
+        'system': ANALYSIS_INSTRUCTIONS,
+        'messages': [{"role": "user", "content": content}]
+    }
+
+def build_analysis_prompt(text_sample, title, part=None):
+    """Prompt asking for a JSON analysis of a document (or of one part of it)"""
+    subject = f'Analyze part {part[0]} of {part[1]} of this research document titled "{title}".' if part \
+        else f'Analyze this research document titled "{title}".'
+    return f"""{subject}
+
+Text: {text_sample}"""
+
+def parse_analysis_message(message):
+    """Parse the JSON analysis out of a model response"""
+    # Extract text from response
+    response_text = message.content[0].text
+    # Remove markdown code blocks if present
+    response_text = response_text.replace('```json', '').replace('```', '').strip()
+    
+    return json.loads(response_text)
+
+def max_analysis_chunks():
+    """Chunks per document: ANALYSIS_MAX_CHUNKS, fewer if their calls would take over half the token budget"""
+    chunk_cost = ANALYSIS_CHUNK_TOKENS + ANALYSIS_PROMPT_OVERHEAD_TOKENS + ANALYSIS_MAX_OUTPUT_TOKENS
+    return max(1, min(ANALYSIS_MAX_CHUNKS, ANALYSIS_TOKENS_PER_MINUTE // 2 // chunk_cost))
+
+def split_analysis_chunks(text):
+    """Split text into ~ANALYSIS_CHUNK_TOKENS chunks, keeping at most max_analysis_chunks() spread across it"""
+    chunk_chars = ANALYSIS_CHUNK_TOKENS * CHARS_PER_TOKEN
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = start + chunk_chars
+        if end < len(text):
+            # Prefer to cut at a paragraph, then a sentence, then a word boundary
+            for boundary in ('\n\n', '. ', ' '):
+                cut = text.rfind(boundary, start + chunk_chars // 2, end)
+                if cut != -1:
+                    end = cut + len(boundary)
+                    break
+        chunks.append(text[start:end])
+        start = end
+    
+    limit = max_analysis_chunks()
+    if len(chunks) > limit:
+        step = len(chunks) / limit
+        chunks = [chunks[int(i * step)] for i in range(limit)]
+    return chunks
+
+def rank_terms(term_lists, limit=None):
+    """Merge term lists case-insensitively, ranked by how many lists mention them"""
+    counts = Counter()
+    first_seen = {}
+    for terms in term_lists:
+        for term in dict.fromkeys(t.strip() for t in terms if isinstance(t, str) and t.strip()):
+            key = term.lower()
+            counts[key] += 1
+            first_seen.setdefault(key, (len(first_seen), term))
+    ranked = sorted(counts, key=lambda key: (-counts[key], first_seen[key][0]))
+    return [first_seen[key][1] for key in ranked[:limit]]
+
+def build_reduce_prompt(partials, title):
+    """Prompt merging chunk analyses into one, plus a locally merged fallback"""
+    keywords = rank_terms([p.get('keywords', []) for p in partials])
+    entities = rank_terms([p.get('entities', []) for p in partials])
+    topics = Counter(p.get('topic') for p in partials if p.get('topic'))
+    
+    fallback = {
+        "summary": partials[0].get('summary', ''),
+        "keywords": keywords[:8],
+        "entities": entities[:8],
+        "topic": topics.most_common(1)[0][0] if topics else "General"
+    }
+    
+    summaries = '\n'.join(f'Part {i + 1}: {p.get("summary", "")}' for i, p in enumerate(partials))
+    prompt = f"""These are analyses of parts of the research document titled "{title}".
+
+Part summaries:
+{summaries}
+
+Candidate keywords (most frequent first): {json.dumps(keywords[:30])}
+Candidate entities (most frequent first): {json.dumps(entities[:30])}
+Candidate topics: {json.dumps([topic for topic, _ in topics.most_common(5)])}
+
+Merge them into one analysis of the whole document."""
+    return prompt, fallback
+
+def finish_reduce(analysis):
+    """Deduplicate the keywords and entities of a merged analysis"""
+    analysis['keywords'] = rank_terms([analysis.get('keywords', [])])
+    analysis['entities'] = rank_terms([analysis.get('entities', [])])
+    return analysis
+
+def map_reduce_analysis(chunks, title, on_text=None):
+    """Analyze chunks concurrently, then merge them with one reduce call"""
+    service = get_analysis_service()
+    requests = [analysis_request(build_analysis_prompt(chunk, title, (i + 1, len(chunks))))
+                for i, chunk in enumerate(chunks)]
+    
+    partials = []
+    for result in service.create_messages(requests):
+        try:
+            if isinstance(result, Exception):
+                raise result
+            partials.append(parse_analysis_message(result))
+        except Exception as e:
+            print(f"Error analyzing document chunk: {e}")
+    
+    if not partials:
+        raise RuntimeError('Every chunk analysis failed')
+    
+    reduce_prompt, fallback = build_reduce_prompt(partials, title)
+    try:
+        message = service.create_message(on_text=on_text, **analysis_request(reduce_prompt))
+        return finish_reduce(parse_analysis_message(message))
+    except Exception as e:
+        # Fall back to a local merge of the chunk results
+        print(f"Error merging chunk analyses: {e}")
+        return fallback
+
+# Share of the sampling budget given to each kind of section; 0 means the section is never sent
+SECTION_WEIGHTS = {
+    'abstract': 6,
+    'summary': 5,
+    'conclusion': 5,
+    'introduction': 4,
+    'discussion': 3,
+    'results': 2,
+    'background': 1,
+    'methods': 1,
+    'body': 1,
+    'front': 1,
+    'references': 0,
+    'acknowledgements': 0,
+    'appendix': 0
+}
+SECTION_NAMES = [
+    ('abstract', r'abstract'),
+    ('summary', r'(?:executive\s+)?summary'),
+    ('conclusion', r'conclusions?|concluding\s+remarks'),
+    ('introduction', r'introduction'),
+    ('discussion', r'discussion'),
+    ('results', r'results(?:\s+and\s+discussion)?|findings|evaluation|experiments'),
+    ('background', r'background|related\s+work|literature\s+review'),
+    ('methods', r'methods?|methodology|materials\s+and\s+methods'),
+    ('references', r'references|bibliography|works\s+cited'),
+    ('acknowledgements', r'acknowledge?ments?'),
+    ('appendix', r'appendix(?:\s+\w+)?|supplementary\s+materials?')
+]
+SECTION_NUMBER = r'(?:(?:\d+(?:\.\d+)*|[IVX]+)\.?[ \t]+)?'
+# A heading seen this many times is a running header or footer rather than a section
+REPEATED_HEADING_MIN = 3
+# A known section name alone on its line (or followed by a colon/dash), a short numbered title, or an ALL CAPS line
+HEADING_PATTERN = re.compile(
+    rf'^[ \t]*(?P<heading>{SECTION_NUMBER}(?i:{"|".join(p for _, p in SECTION_NAMES)})[ \t]*(?:[:.\u2014-]|$)'
+    r'|(?:\d+(?:\.\d+)*|[IVX]+)\.?[ \t]+[A-Z][^\n.]{2,70}$'
+    r'|[A-Z][A-Z \t-]{3,60}$)', re.M)
+BOILERPLATE_PATTERN = re.compile(r'copyright|\u00a9|all rights reserved|licen[cs]e|arxiv:|doi:|https?://|'
+                                 r'permission to|preprint|downloaded from', re.I)
+
+def section_kind(heading):
+    """Classify a heading as one of SECTION_WEIGHTS' kinds"""
+    name = re.sub(SECTION_NUMBER, '', heading.strip(), count=1).strip(' \t:.\u2014-')
+    for kind, pattern in SECTION_NAMES:
+        if re.fullmatch(pattern, name, re.I):
+            return kind
+    return 'body'
+
+def collapse_repeated_headings(text):
+    """Drop headings that recur on many pages (running headers and footers), leaving their text in the section"""
+    def key(match):
+        return ' '.join(re.sub(r'\d+', '', match.group('heading')).lower().split())
+    counts = Counter(key(match) for match in HEADING_PATTERN.finditer(text))
+    return HEADING_PATTERN.sub(lambda match: '' if counts[key(match)] >= REPEATED_HEADING_MIN else match.group(0),
+                               text)
+
+def find_sections(text):
+    """Split text at recognizable headings into [(kind, heading, body)] in document order"""
+    sections = []
+    kind, heading, start = 'front', '', 0
+    for match in HEADING_PATTERN.finditer(text):
+        sections.append((kind, heading, text[start:match.start()]))
+        heading = match.group('heading').strip()
+        kind = section_kind(heading)
+        start = match.end()
+    sections.append((kind, heading, text[start:]))
+    return [section for section in sections if section[1] or section[2].strip()]
+
+def clean_section(body):
+    """Collapse whitespace and drop short license/copyright/link lines"""
+    lines = [line for line in body.splitlines() if not (len(line) < 200 and BOILERPLATE_PATTERN.search(line))]
+    return ' '.join(' '.join(lines).split())
+
+def allocate_budget(budget, sizes, weights):
+    """Split `budget` in proportion to `weights`, giving what small sections cannot use to the others"""
+    allocation = [0.0] * len(sizes)
+    active = {i for i, weight in enumerate(weights) if weight > 0 and sizes[i] > 0}
+    while active:
+        remaining = budget - sum(allocation)
+        total_weight = sum(weights[i] for i in active)
+        filled = set()
+        for i in active:
+            allocation[i] = min(sizes[i], allocation[i] + remaining * weights[i] / total_weight)
+            if allocation[i] >= sizes[i]:
+                filled.add(i)
+        if not filled:
+            break
+        active -= filled
+    return [int(amount) for amount in allocation]
+
+def leading_span(text, limit):
+    """The first `limit` characters of text, cut back to a sentence end when one is close"""
+    if limit <= 0:
+        return ''
+    if len(text) <= limit:
+        return text
+    cut = text.rfind('. ', limit * 2 // 3, limit)
+    return text[:cut + 1] if cut != -1 else text[:limit]
+
+def sample_sections(text, budget_tokens):
+    """Fill a token budget with the most informative parts of a document
+    
+    Sections are recognized by their headings (abstract, introduction, conclusion, ...) and each gets a share of
+    the budget by kind; references, acknowledgements and appendices are skipped. Documents without recognizable
+    structure are sampled from their start, middle and end.
+    """
+    budget = budget_tokens * CHARS_PER_TOKEN
+    if len(text) <= budget:
+        return text
+    
+    sections = [(kind, heading, clean_section(body))
+                for kind, heading, body in find_sections(collapse_repeated_headings(text))]
+    weights = [SECTION_WEIGHTS.get(kind, 1) for kind, _, _ in sections]
+    if sum(1 for weight in weights if weight) < 3:
+        body = clean_section(text)
+        fifth = len(body) // 5
+        sections = [('body', '', body[i * fifth:(i + 1) * fifth]) for i in range(5)]
+        weights = [3, 1, 1, 1, 2]
+    
+    # A short outline of every heading tells the model how the document is organized
+    outline = ' / '.join(heading for _, heading, _ in sections if heading)[:budget // 10]
+    if outline:
+        outline = f'Outline: {outline}\n\n'
+    
+    headers = [len(heading) + 4 for _, heading, _ in sections]
+    allocation = allocate_budget(max(budget - len(outline) - sum(headers), 0), [len(body) for _, _, body in sections],
+                                 weights)
+    spans = []
+    for (kind, heading, body), limit in zip(sections, allocation):
+        span = leading_span(body, limit)
+        if span:
+            spans.append(f'[{heading}] {span}' if heading else span)
+    # Headers of many short sections can still add up past the budget
+    return (outline + '\n[...]\n'.join(spans))[:budget]
+
+def informative_text(text):
+    """The document without its references, acknowledgements and appendices"""
+    sections = find_sections(text)
+    kept = [f'{heading}\n{body}' for kind, heading, body in sections if SECTION_WEIGHTS.get(kind, 1)]
+    return '\n'.join(kept) if kept else text
+
+def analysis_chunks(text):
+    """The text pieces sent for analysis under the current ANALYSIS_MODE"""
+    if len(text) <= ANALYSIS_INPUT_TOKENS * CHARS_PER_TOKEN:
+        return [text]
+    if ANALYSIS_MODE == 'map_reduce':
+        return split_analysis_chunks(informative_text(text))
+    return [sample_sections(text, ANALYSIS_INPUT_TOKENS)]
+
+def measure_input_tokens(request_kwargs, limit):
+    """Input tokens of a request: estimated, and measured by the API when enabled and the estimate is near `limit`"""
+    estimate = request_chars(request_kwargs) // CHARS_PER_TOKEN
+    if ANALYSIS_TOKEN_COUNTING == 'api' and estimate >= limit * ANALYSIS_TOKEN_COUNT_MARGIN:
+        try:
+            return get_analysis_service().count_tokens(request_kwargs)
+        except Exception as e:
+            print(f"Error counting tokens, estimating instead: {e}")
+    return estimate
+
+def budgeted_analysis_request(text, sample, title):
+    """Build the request for a single-call analysis, resampling once if it measures over the token budget"""
+    request_kwargs = analysis_request(build_analysis_prompt(sample, title))
+    limit = ANALYSIS_INPUT_TOKENS + ANALYSIS_PROMPT_OVERHEAD_TOKENS
+    measured = measure_input_tokens(request_kwargs, limit)
+    if measured > limit:
+        # Dense text (numbers, code, non-English) runs more tokens per character than the estimate
+        budget = int(ANALYSIS_INPUT_TOKENS * ANALYSIS_INPUT_TOKENS / max(measured - ANALYSIS_PROMPT_OVERHEAD_TOKENS, 1))
+        request_kwargs = analysis_request(build_analysis_prompt(sample_sections(text, budget), title))
+    return request_kwargs
+
+ANALYSIS_UNAVAILABLE = {
+    "summary": "Analysis unavailable",
+    "keywords": [],
+    "entities": [],
+    "topic": "General",
+    "pending": True
+}
+
+def analyze_document_with_ai(text, title, force=False, on_text=None):
+    """Use Claude API to analyze document (cached; force=True skips the cache lookup)
+    
+    `on_text` receives the model's output as it streams in (for long documents, that of the merge call), and None
+    when the output streamed so far is void because the call failed.
+    """
+    chunks = analysis_chunks(text)
+    cache_key = analysis_cache_key('\x00'.join(chunks), title)
+    
+    if not force:
+        cached = get_cached_analysis(cache_key)
+        if cached is not None:
+            return cached
+    
+    try:
+        if len(chunks) == 1:
+            message = get_analysis_service().create_message(
+                on_text=on_text, **budgeted_analysis_request(text, chunks[0], title))
+            analysis = parse_analysis_message(message)
+        else:
+            analysis = map_reduce_analysis(chunks, title, on_text)
     except Exception as e:
         print(f"Error analyzing document: {e}")
-        return {
-            "summary": "Analysis unavailable",
-            "keywords": [],
-            "entities": [],
-            "topic": "General"
+        return dict(ANALYSIS_UNAVAILABLE)
+    
+    # Failures above are never cached, so they are retried next time
+    try:
+        put_cached_analysis(cache_key, analysis)
+    except sqlite3.Error as e:
+        print(f"Error caching analysis: {e}")
+    return analysis
+
+STOPWORDS = frozenset("""
+a about above after again against all also am an and any are as at be because been before being below between
+both but by can could did do does doing down due during each either et etc few for from further had has have having he
+her here hers herself him himself his how however i if in into is it its itself just may me might more most must my
+myself no nor not now of off on once only or other our ours ourselves out over own per same shall she should so
+some such than that the their theirs them themselves then there these they this those through thus to too under
+until up upon us use used using very via was we were what when where which while who whom why will with within
+without would yet you your yours yourself yourselves
+one two three first second new well many much also may figure fig table section page vol pp
+""".split())
+WORD_PATTERN = re.compile(r"[A-Za-z][A-Za-z-]*[A-Za-z]")
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+(?=[A-Z0-9\"'(])")
+# Names run along one line only, so headings do not merge with the text that follows them
+ENTITY_PATTERN = re.compile(r"\b(?:[A-Z][a-z]+|[A-Z]{2,})"
+                            r"(?:[ \t]+(?:of[ \t]+|de[ \t]+|the[ \t]+)?(?:[A-Z][a-z]+|[A-Z]{2,})){0,3}\b")
+
+def content_words(text):
+    """Lower-cased words of a text with stopwords and very short words removed"""
+    return [word for word in WORD_PATTERN.findall(text.lower()) if len(word) > 2 and word not in STOPWORDS]
+
+def document_terms(text):
+    """The distinct words of a document counted in corpus_terms
+    
+    Tokenizing a long document takes a while, so callers do it before queueing the write that uses the terms.
+    """
+    return list(set(content_words(text)))
+
+def update_corpus_terms(c, terms, delta):
+    """Add (delta=1) or remove (delta=-1) one document's terms (from document_terms) to the corpus term counts"""
+    terms = [(term, delta) for term in terms]
+    c.executemany('''INSERT INTO corpus_terms (term, doc_count) VALUES (?, ?)
+                     ON CONFLICT(term) DO UPDATE SET doc_count = doc_count + excluded.doc_count''', terms)
+    if delta < 0:
+        c.execute('DELETE FROM corpus_terms WHERE doc_count <= 0')
+
+def corpus_frequencies(terms):
+    """Return (number of documents, {term: documents containing it}) for the given terms"""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT COUNT(*) FROM documents')
+    total = c.fetchone()[0]
+    frequencies = {}
+    terms = list(terms)
+    # Stay under SQLite's host parameter limit
+    for start in range(0, len(terms), 500):
+        part = terms[start:start + 500]
+        c.execute(f'SELECT term, doc_count FROM corpus_terms WHERE term IN ({",".join("?" * len(part))})', part)
+        frequencies.update(c.fetchall())
+    return total, frequencies
+
+def tfidf_keywords(words, limit=LOCAL_KEYWORDS):
+    """Rank single words and adjacent word pairs by TF-IDF against the corpus term counts"""
+    counts = Counter(words)
+    pairs = Counter(f'{a} {b}' for a, b in zip(words, words[1:]) if a != b)
+    candidates = [word for word, _ in counts.most_common(300)]
+    total, frequencies = corpus_frequencies(candidates)
+    
+    # Smoothed IDF; the document being analyzed may not be stored yet, hence the +1s
+    idf = {word: math.log((total + 1) / (frequencies.get(word, 0) + 1)) + 1 for word in candidates}
+    scores = {word: counts[word] * idf[word] for word in candidates}
+    for pair, count in pairs.most_common(100):
+        first, second = pair.split(' ')
+        if count > 1 and first in idf and second in idf:
+            scores[pair] = count * (idf[first] + idf[second])
+    
+    keywords = []
+    for term, _ in sorted(scores.items(), key=lambda item: item[1], reverse=True):
+        # Skip terms already covered by a higher-ranked pair or word
+        if any(set(term.split(' ')) & set(chosen.split(' ')) for chosen in keywords):
+            continue
+        keywords.append(term)
+        if len(keywords) == limit:
+            break
+    return keywords
+
+def textrank_summary(text, limit=LOCAL_SUMMARY_SENTENCES):
+    """Pick the most central sentences (TextRank over word-overlap similarity), in document order"""
+    sentences = [' '.join(s.split()) for s in SENTENCE_PATTERN.split(text[:200000])]
+    sentences = [s for s in sentences if 40 <= len(s) <= 600][:LOCAL_MAX_SENTENCES]
+    if len(sentences) <= limit:
+        return ' '.join(sentences)
+    
+    word_sets = [set(content_words(sentence)) for sentence in sentences]
+    count = len(sentences)
+    weights = [[0.0] * count for _ in range(count)]
+    for i in range(count):
+        for j in range(i + 1, count):
+            overlap = len(word_sets[i] & word_sets[j])
+            if overlap and len(word_sets[i]) > 1 and len(word_sets[j]) > 1:
+                weight = overlap / (math.log(len(word_sets[i])) + math.log(len(word_sets[j])))
+                weights[i][j] = weights[j][i] = weight
+    
+    # Power iteration over the sparse neighbour lists
+    totals = [sum(row) or 1.0 for row in weights]
+    neighbours = [[(j, weights[j][i] / totals[j]) for j in range(count) if weights[j][i]] for i in range(count)]
+    scores = [1.0] * count
+    for _ in range(30):
+        scores = [0.15 + 0.85 * sum(share * scores[j] for j, share in neighbours[i]) for i in range(count)]
+    
+    best = sorted(sorted(range(count), key=lambda i: scores[i], reverse=True)[:limit])
+    return ' '.join(sentences[i] for i in best)
+
+def rule_based_entities(text, limit=LOCAL_ENTITIES):
+    """Frequent capitalized phrases and acronyms that do not just start a sentence"""
+    counts = Counter()
+    for sentence in SENTENCE_PATTERN.split(text[:200000]):
+        for match in ENTITY_PATTERN.finditer(sentence):
+            entity = match.group(0)
+            words = entity.split()
+            if match.start() == 0 and len(words) == 1:
+                continue
+            if words[0].lower() in STOPWORDS or len(entity) < 3:
+                continue
+            counts[entity] += 1
+    return [entity for entity, count in counts.most_common(limit * 3) if count > 1 or ' ' in entity][:limit]
+
+def analyze_document_locally(text, title, force=False, on_text=None):
+    """Analyze a document without any API calls: TF-IDF keywords, extractive summary, rule-based entities"""
+    words = content_words(text)
+    keywords = tfidf_keywords(words) if words else []
+    summary = textrank_summary(text) or text[:300].strip() or "No text to summarize"
+    return {
+        "summary": summary,
+        "keywords": keywords,
+        "entities": rule_based_entities(text),
+        "topic": keywords[0].title() if keywords else "General"
+    }
+
+# Analyzer backends take (text, title, force, on_text) and return a summary/keywords/entities/topic dict
+ANALYZERS = {
+    'claude': analyze_document_with_ai,
+    'local': analyze_document_locally
+}
+
+def analyzes_locally(backend=None):
+    """Whether the configured (or given) analyzer backend answers with the local analyzer alone"""
+    backend = backend or ANALYZER_BACKEND
+    return backend == 'local' or (backend == 'auto' and not os.environ.get('ANTHROPIC_API_KEY'))
+
+def analyze_document(text, title, force=False, backend=None, on_text=None):
+    """Analyze a document with the configured (or given) analyzer backend"""
+    backend = backend or ANALYZER_BACKEND
+    if backend != 'auto':
+        return ANALYZERS[backend](text, title, force, on_text)
+    
+    if analyzes_locally(backend):
+        return analyze_document_locally(text, title)
+    analysis = analyze_document_with_ai(text, title, force, on_text)
+    if analysis.get('pending'):
+        # Stand in until the document is requeued for AI analysis
+        return dict(analyze_document_locally(text, title), pending=True)
+    return analysis
+
+def analyze_tracked(text, title, **kwargs):
+    """analyze_document that also returns the ids of the model calls it made"""
+    with track_analysis_calls() as call_ids:
+        return analyze_document(text, title, **kwargs), call_ids
+
+class LocalMessageBatches:
+    """In-process stand-in for client.messages.batches that answers through the analysis service"""
+    
+    def __init__(self):
+        self.batches = {}
+        self.lock = threading.Lock()
+    
+    def create(self, requests):
+        batch_id = 'msgbatch_local_' + uuid.uuid4().hex
+        with self.lock:
+            self.batches[batch_id] = {'status': 'in_progress', 'results': []}
+        threading.Thread(target=self.process, args=(batch_id, requests), daemon=True).start()
+        return self.retrieve(batch_id)
+    
+    def process(self, batch_id, requests):
+        # Accounted for by run_message_batch, like real batch results
+        outcomes = get_analysis_service().create_messages([r['params'] for r in requests], record=False)
+        results = []
+        for r, outcome in zip(requests, outcomes):
+            if isinstance(outcome, Exception):
+                result = SimpleNamespace(type='errored', error=str(outcome))
+            else:
+                result = SimpleNamespace(type='succeeded', message=outcome)
+            results.append(SimpleNamespace(custom_id=r['custom_id'], result=result))
+        with self.lock:
+            self.batches[batch_id] = {'status': 'ended', 'results': results}
+    
+    def retrieve(self, batch_id):
+        with self.lock:
+            return SimpleNamespace(id=batch_id, processing_status=self.batches[batch_id]['status'])
+    
+    def results(self, batch_id):
+        with self.lock:
+            return iter(self.batches.pop(batch_id)['results'])
+
+def get_batch_api():
+    """Batch submission API for the configured ANALYSIS_BATCH_BACKEND"""
+    global local_batches
+    if ANALYSIS_BATCH_BACKEND == 'local':
+        with analysis_service_lock:
+            if local_batches is None:
+                local_batches = LocalMessageBatches()
+            return local_batches
+    return client.messages.batches
+
+def run_message_batch(batch_api, requests, job_id):
+    """Submit one batch, wait for it to end and return {custom_id: parsed analysis} for the successes"""
+    batch = batch_api.create(requests=requests)
+    update_job(job_id, batch_id=batch.id)
+    poll_seconds = min(REANALYSIS_POLL_SECONDS, 1) if ANALYSIS_BATCH_BACKEND == 'local' else REANALYSIS_POLL_SECONDS
+    while batch.processing_status != 'ended':
+        time.sleep(poll_seconds)
+        batch = batch_api.retrieve(batch.id)
+    
+    outputs = {}
+    for entry in batch_api.results(batch.id):
+        if entry.result.type != 'succeeded':
+            continue
+        message = entry.result.message
+        try:
+            record_analysis_call(getattr(message, 'model', None) or ANALYSIS_MODEL, getattr(message, 'usage', None),
+                                 batch=ANALYSIS_BATCH_BACKEND != 'local', doc_id=int(entry.custom_id.split('-')[1]))
+        except sqlite3.Error as e:
+            print(f"Error recording analysis call: {e}")
+        try:
+            outputs[entry.custom_id] = parse_analysis_message(entry.result.message)
+        except Exception as e:
+            print(f"Error parsing batch result {entry.custom_id}: {e}")
+    return outputs
+
+def apply_analyses(c, analyses):
+    """Write many {doc_id: analysis} results with batched statements"""
+    if not analyses:
+        return
+    doc_ids = list(analyses)
+    placeholders = ','.join('?' * len(doc_ids))
+    
+    c.executemany("UPDATE documents SET summary = ?, topic = ?, analysis_status = 'done' WHERE id = ?",
+                  [(a['summary'], a['topic'], doc_id) for doc_id, a in analyses.items()])
+    c.execute(f'DELETE FROM keywords WHERE doc_id IN ({placeholders})', doc_ids)
+    c.execute(f'DELETE FROM entities WHERE doc_id IN ({placeholders})', doc_ids)
+    c.executemany('INSERT INTO keywords (doc_id, keyword) VALUES (?, ?)',
+                  [(doc_id, keyword) for doc_id, a in analyses.items() for keyword in a['keywords']])
+    c.executemany('INSERT INTO entities (doc_id, entity) VALUES (?, ?)',
+                  [(doc_id, entity) for doc_id, a in analyses.items() for entity in a['entities']])
+
+def reanalyze_group(batch_api, job_id, doc_ids):
+    """Reanalyze one group of documents via batch submissions; returns (updated, failed)"""
+    conn = get_db()
+    c = conn.cursor()
+    placeholders = ','.join('?' * len(doc_ids))
+    c.execute(f'''SELECT d.id, d.title, p.body FROM documents d
+                   LEFT JOIN document_pages p ON p.doc_id = d.id
+                   WHERE d.id IN ({placeholders})
+                   ORDER BY d.id, p.page_number''', doc_ids)
+    texts = {}
+    titles = {}
+    for doc_id, title, body in c.fetchall():
+        titles[doc_id] = title
+        texts.setdefault(doc_id, []).append(decompress_content(body) if body else '')
+    docs = {}
+    for doc_id, title in titles.items():
+        chunks = analysis_chunks(''.join(texts[doc_id]))
+        docs[doc_id] = {'title': title, 'chunks': chunks,
+                        'cache_key': analysis_cache_key('\x00'.join(chunks), title)}
+    
+    # Documents whose inputs were already analyzed under the current prompt skip the API
+    results = {}
+    fresh = {}
+    for doc_id, doc in docs.items():
+        cached = get_cached_analysis(doc['cache_key'])
+        if cached is not None:
+            results[doc_id] = cached
+    
+    # Map phase: one request per chunk (a single one for short documents)
+    requests = []
+    for doc_id, doc in docs.items():
+        if doc_id in results:
+            continue
+        count = len(doc['chunks'])
+        for i, chunk in enumerate(doc['chunks']):
+            prompt = build_analysis_prompt(chunk, doc['title'], (i + 1, count) if count > 1 else None)
+            requests.append({'custom_id': f'doc-{doc_id}-{i}', 'params': analysis_request(prompt)})
+    outputs = run_message_batch(batch_api, requests, job_id) if requests else {}
+    
+    # Reduce phase for documents that were split
+    reduce_requests = []
+    fallbacks = {}
+    for doc_id, doc in docs.items():
+        if doc_id in results:
+            continue
+        partials = [outputs[key] for key in (f'doc-{doc_id}-{i}' for i in range(len(doc['chunks'])))
+                    if key in outputs]
+        if not partials:
+            continue
+        if len(doc['chunks']) == 1:
+            fresh[doc_id] = partials[0]
+        else:
+            prompt, fallbacks[doc_id] = build_reduce_prompt(partials, doc['title'])
+            reduce_requests.append({'custom_id': f'doc-{doc_id}-reduce', 'params': analysis_request(prompt)})
+    if reduce_requests:
+        outputs = run_message_batch(batch_api, reduce_requests, job_id)
+        for doc_id, fallback in fallbacks.items():
+            merged = outputs.get(f'doc-{doc_id}-reduce')
+            fresh[doc_id] = finish_reduce(merged) if merged else fallback
+    
+    for doc_id, analysis in fresh.items():
+        put_cached_analysis(docs[doc_id]['cache_key'], analysis)
+    results.update(fresh)
+    
+    db_writer.run(apply_analyses, results)
+    
+    return len(results), len(docs) - len(results)
+
+def run_bulk_reanalysis(job_id, doc_ids):
+    """Reanalyze documents in groups of REANALYSIS_DOCS_PER_BATCH (runs on its own thread)"""
+    try:
+        batch_api = get_batch_api()
+        updated = failed = 0
+        update_job(job_id, status='analyzing')
+        for start in range(0, len(doc_ids), REANALYSIS_DOCS_PER_BATCH):
+            group_updated, group_failed = reanalyze_group(batch_api, job_id,
+                                                          doc_ids[start:start + REANALYSIS_DOCS_PER_BATCH])
+            updated += group_updated
+            failed += group_failed
+            update_job(job_id, updated=updated, failed=failed,
+                       progress=min(100, int(100 * (start + REANALYSIS_DOCS_PER_BATCH) / len(doc_ids))))
+        update_job(job_id, status='done', progress=100)
+    except Exception as e:
+        print(f"Error in bulk reanalysis: {e}")
+        update_job(job_id, status='failed', error=str(e))
+    finally:
+        with jobs_lock:
+            for doc_id in doc_ids:
+                reanalyzing_doc_ids[doc_id] -= 1
+                if reanalyzing_doc_ids[doc_id] <= 0:
+                    del reanalyzing_doc_ids[doc_id]
+
+def start_reanalysis(doc_ids):
+    """Start a bulk reanalysis job on its own thread; returns the job id"""
+    job_id = create_job(None)
+    with jobs_lock:
+        reanalyzing_doc_ids.update(doc_ids)
+    update_job(job_id, kind='reanalysis', total=len(doc_ids), updated=0, failed=0)
+    threading.Thread(target=run_bulk_reanalysis, args=(job_id, doc_ids), name='reanalysis', daemon=True).start()
+    return job_id
+
+def requeue_pending_analyses():
+    """Reanalyze documents marked pending (called when the circuit breaker closes again)
+    
+    Batches can take hours, and documents stay pending until theirs ends: a provider that keeps failing and
+    recovering must not submit the same documents again, so this does nothing while an earlier requeue job is still
+    running and skips documents that another reanalysis job is working on.
+    """
+    global requeue_job_id
+    # Skip if a previous requeue is still collecting ids
+    if not requeue_lock.acquire(blocking=False):
+        return None
+    try:
+        with jobs_lock:
+            previous = jobs.get(requeue_job_id)
+            if previous is not None and previous['status'] not in ('done', 'failed'):
+                return None
+        conn = get_db()
+        c = conn.cursor()
+        c.execute("SELECT id FROM documents WHERE analysis_status = 'pending' ORDER BY id")
+        with jobs_lock:
+            doc_ids = [row[0] for row in c.fetchall() if row[0] not in reanalyzing_doc_ids]
+            if not doc_ids:
+                return None
+            print(f"Analysis provider recovered; requeueing {len(doc_ids)} pending documents")
+            requeue_job_id = start_reanalysis(doc_ids)
+            return requeue_job_id
+    except sqlite3.Error as e:
+        print(f"Error requeueing pending analyses: {e}")
+        return None
+    finally:
+        requeue_lock.release()
+
+def create_job(filename, content_hash=None):
+    """Register a new ingestion job and return its id"""
+    job_id = uuid.uuid4().hex
+    now = datetime.now().isoformat()
+    with jobs_lock:
+        # Forget the oldest finished jobs so the registry stays bounded
+        if len(jobs) >= MAX_TRACKED_JOBS:
+            finished = [j for j in jobs.values() if j['status'] in ('done', 'failed')]
+            finished.sort(key=lambda j: j['updated_at'])
+            for job in finished[:len(jobs) - MAX_TRACKED_JOBS + 1]:
+                del jobs[job['id']]
+                job_events.pop(job['id'], None)
+        jobs[job_id] = {
+            'id': job_id,
+            'filename': filename,
+            'content_hash': content_hash,
+            'status': 'queued',
+            'progress': 0,
+            'doc_id': None,
+            'analysis': None,
+            'error': None,
+            'created_at': now,
+            'updated_at': now
         }
+        job_events[job_id] = []
+        if filename is not None:
+            append_job_event(job_id, 'saved', {'filename': filename, 'content_hash': content_hash})
+        append_job_event(job_id, 'status', {'status': 'queued', 'progress': 0})
+    return job_id
+
+def append_job_event(job_id, event, data):
+    """Record an event for a job's event stream (caller holds jobs_lock)"""
+    events = job_events.get(job_id)
+    if events is not None:
+        events.append({'event': event, 'data': data})
+        jobs_changed.notify_all()
+
+def publish_job_event(job_id, event, data):
+    """Record an event for a job's event stream and wake its listeners"""
+    with jobs_lock:
+        append_job_event(job_id, event, data)
+
+def update_job(job_id, **fields):
+    """Update the status fields of an ingestion job, publishing status changes to its event stream"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is None:
+            return
+        changed = 'status' in fields and fields['status'] != job['status']
+        job.update(fields)
+        job['updated_at'] = datetime.now().isoformat()
+        if changed or 'progress' in fields:
+            append_job_event(job_id, 'status', {'status': job['status'], 'progress': job['progress']})
+        if changed and job['status'] == 'done':
+            append_job_event(job_id, 'done', {'doc_id': job['doc_id'], 'analysis': job['analysis']})
+        elif changed and job['status'] == 'failed':
+            append_job_event(job_id, 'failed', {'error': job['error'],
+                                                'extraction_error': job.get('extraction_error')})
+
+def split_text_pages(text):
+    """Split unpaginated text into pages of about TEXT_PAGE_CHARS characters, preferring line breaks"""
+    pages = []
+    start = 0
+    while start < len(text):
+        end = start + TEXT_PAGE_CHARS
+        if end < len(text):
+            newline = text.rfind('\n', start, end)
+            if newline > start:
+                end = newline + 1
+        pages.append(text[start:end])
+        start = end
+    return pages
+
+def extract_text_pages(file_path, file_ext, content_hash=None):
+    """Extract text as a list of pages based on file type, raising ExtractionError on failure"""
+    if file_ext == 'pdf':
+        try:
+            pages = extract_pdf_pages(file_path, content_hash)
+        except ExtractionError as e:
+            print(f"Error extracting PDF text from {file_path}: {e.reason}: {e}")
+            raise
+        except Exception as e:
+            print(f"Error extracting PDF text: {e}")
+            raise ExtractionError('unreadable', str(e))
+    else:
+        text = extract_text_from_txt(file_path, content_hash)
+        if text is None:
+            raise ExtractionError('unreadable', 'Could not read text file')
+        pages = split_text_pages(text)
+    
+    if not ''.join(pages):
+        raise ExtractionError('empty', 'Could not extract text from file')
+    return pages
+
+def compress_content(text):
+    """Return (compressed body, uncompressed length in characters) of a piece of text"""
+    return zlib.compress(text.encode('utf-8'), CONTENT_COMPRESSION_LEVEL), len(text)
+
+def decompress_content(body):
+    return zlib.decompress(body).decode('utf-8')
+
+def store_pages(c, doc_id, pages):
+    """Insert the per-page text of a document, compressed"""
+    rows = []
+    offset = 0
+    for page_number, page_text in enumerate(pages, start=1):
+        rows.append((doc_id, page_number, offset, *compress_content(page_text)))
+        offset += len(page_text)
+    c.executemany('INSERT INTO document_pages (doc_id, page_number, char_offset, body, length) '
+                  'VALUES (?, ?, ?, ?, ?)', rows)
+
+def load_content(c, doc_id):
+    """Return the full text of a document, rebuilt from its pages, or None when it has none"""
+    c.execute('SELECT body FROM document_pages WHERE doc_id = ? ORDER BY page_number', (doc_id,))
+    bodies = c.fetchall()
+    return ''.join(decompress_content(body[0]) for body in bodies) if bodies else None
+
+def store_document(c, title, unique_filename, file_path, text_content, analysis, file_ext, content_hash=None,
+                   pages=None, call_ids=None, terms=None):
+    """Insert a processed document and its analysis rows, returning the new id
+    
+    Pass `terms` (from document_terms) when storing through db_writer, so the text is not tokenized on the writer
+    thread.
+    """
+    c.execute('''INSERT INTO documents 
+                 (title, filename, file_path, summary, topic, upload_date, file_type, content_hash, analysis_status)
+                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+              (title, unique_filename, file_path,
+               analysis['summary'], analysis['topic'], 
+               datetime.now().isoformat(), file_ext, content_hash,
+               'pending' if analysis.get('pending') else 'done'))
+    
+    doc_id = c.lastrowid
+    
+    # Store keywords
+    for keyword in analysis['keywords']:
+        c.execute('INSERT INTO keywords (doc_id, keyword) VALUES (?, ?)', (doc_id, keyword))
+    
+    # Store entities
+    for entity in analysis['entities']:
+        c.execute('INSERT INTO entities (doc_id, entity) VALUES (?, ?)', (doc_id, entity))
+    
+    # Store topic as initial tag
+    c.execute('INSERT INTO tags (doc_id, tag) VALUES (?, ?)', (doc_id, analysis['topic']))
+    
+    store_pages(c, doc_id, pages if pages is not None else split_text_pages(text_content))
+    update_corpus_terms(c, terms if terms is not None else document_terms(text_content), 1)
+    attribute_analysis_calls(c, doc_id, call_ids)
+    
+    return doc_id
+
+def stage_metric(stage, started, size=None, pages=None):
+    """Build an ingest metric for a stage that began at perf_counter() value `started`"""
+    return {
+        'stage': stage,
+        'duration_ms': (time.perf_counter() - started) * 1000,
+        'bytes': size,
+        'pages': pages
+    }
+
+def timed(func, *args):
+    """Call func(*args) and return (result, duration in ms)"""
+    started = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+def record_ingest_metrics(c, doc_id, job_id, metrics):
+    """Insert the stage metrics collected while ingesting a document"""
+    recorded_at = datetime.now().isoformat()
+    c.executemany('''INSERT INTO ingest_metrics (doc_id, job_id, stage, duration_ms, bytes, pages, recorded_at)
+                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                  [(doc_id, job_id, m['stage'], m['duration_ms'], m['bytes'], m['pages'], recorded_at)
+                   for m in metrics])
+
+def save_ingest_metrics(doc_id, job_id, metrics):
+    """Record stage metrics in their own transaction, never failing the caller"""
+    try:
+        db_writer.run(record_ingest_metrics, doc_id, job_id, metrics)
+    except sqlite3.Error as e:
+        print(f"Error recording ingest metrics: {e}")
+
+def process_upload(job_id, file_path, unique_filename, filename, content_hash=None, metrics=None, queued_at=None):
+    """Extract, analyze and store an uploaded file (runs on the ingest pool)"""
+    metrics = list(metrics or [])
+    doc_id = None
+    try:
+        file_ext = filename.rsplit('.', 1)[1].lower()
+        file_size = os.path.getsize(file_path)
+        if queued_at is not None:
+            metrics.append(stage_metric('queue', queued_at))
+        
+        update_job(job_id, status='extracting', progress=10)
+        started = time.perf_counter()
+        try:
+            pages = extract_text_pages(file_path, file_ext, content_hash)
+        except ExtractionError as e:
+            metrics.append(stage_metric('extract', started, file_size))
+            update_job(job_id, status='failed', error=str(e), extraction_error=e.to_dict())
+            return
+        text_content = ''.join(pages)
+        metrics.append(stage_metric('extract', started, file_size, len(pages)))
+        publish_job_event(job_id, 'extracted', {'pages': len(pages), 'characters': len(text_content)})
+        
+        # Analyze document with AI
+        title = filename.rsplit('.', 1)[0]
+        update_job(job_id, status='analyzing', progress=40)
+        started = time.perf_counter()
+        if not analyzes_locally():
+            # Instant first-pass result to show while the model call waits its turn
+            preview = analyze_document_locally(text_content, title)
+            update_job(job_id, preview=preview)
+            publish_job_event(job_id, 'preview', preview)
+        def stream_output(text):
+            if text is None:
+                publish_job_event(job_id, 'reset', {})
+            else:
+                publish_job_event(job_id, 'token', {'text': text})
+        analysis, call_ids = analyze_tracked(text_content, title, on_text=stream_output)
+        metrics.append(stage_metric('analyze', started, len(text_content)))
+        
+        # Store in database
+        update_job(job_id, status='saving', progress=90)
+        started = time.perf_counter()
+        terms = document_terms(text_content)
+        doc_id = db_writer.run(store_document, title, unique_filename, file_path, text_content, analysis,
+                               file_ext, content_hash, pages, call_ids, terms)
+        metrics.append(stage_metric('store', started, len(text_content), len(pages)))
+        
+        update_job(job_id, status='done', progress=100, doc_id=doc_id, analysis=analysis)
+    except Exception as e:
+        print(f"Error processing upload {unique_filename}: {e}")
+        update_job(job_id, status='failed', error=str(e))
+    finally:
+        ingest_slots.release()
+        save_ingest_metrics(doc_id, job_id, metrics)
 
 @app.route('/api/upload', methods=['POST'])
 def upload_file():
-    """Upload and process document"""
+    """Save an uploaded document and queue it for processing"""
     if 'file' not in request.files:
         return jsonify({'error': 'No file provided'}), 400
     
@@ -164,113 +2162,507 @@ def upload_file():
         return jsonify({'error': 'No file selected'}), 400
     
     if file and allowed_file(file.filename):
+        # Refuse new work instead of queueing unboundedly
+        if not ingest_slots.acquire(blocking=False):
+            return jsonify({'error': 'Ingestion queue is full, retry later'}), 503
+        
         filename = secure_filename(file.filename)
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-        unique_filename = timestamp + filename
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+        unique_filename, file_path = build_upload_path(filename)
         
-        file.save(file_path)
+        started = time.perf_counter()
+        try:
+            content_hash = save_upload(file, file_path)
+        except Exception:
+            ingest_slots.release()
+            raise
+        save_metric = stage_metric('save', started, os.path.getsize(file_path))
         
-        # Extract text based on file type
-        file_ext = filename.rsplit('.', 1)[1].lower()
-        if file_ext == 'pdf':
-            text_content = extract_text_from_pdf(file_path)
-        else:
-            text_content = extract_text_from_txt(file_path)
+        # Point at the existing copy instead of reprocessing the same file
+        job_id, existing_doc_id, existing_job_id = claim_upload(filename, content_hash)
+        if job_id is None:
+            ingest_slots.release()
+            os.remove(file_path)
+            return jsonify({
+                'error': 'Document already uploaded',
+                'doc_id': existing_doc_id,
+                'job_id': existing_job_id
+            }), 409
         
-        if not text_content:
-            return jsonify({'error': 'Could not extract text from file'}), 500
+        ingest_executor.submit(process_upload, job_id, file_path, unique_filename, filename, content_hash,
+                               [save_metric], time.perf_counter())
         
-        # Analyze document with AI
-        title = filename.rsplit('.', 1)[0]
-        analysis = analyze_document_with_ai(text_content, title)
+        return jsonify({
+            'message': 'File accepted for processing',
+            'job_id': job_id,
+            'status_url': f'/api/jobs/{job_id}'
+        }), 202
+    
+    return jsonify({'error': 'Invalid file type'}), 400
+
+@app.route('/api/upload/batch', methods=['POST'])
+def upload_batch():
+    """Upload many documents at once and store them in a single transaction"""
+    files = request.files.getlist('files')
+    
+    if not files:
+        return jsonify({'error': 'No files provided'}), 400
+    
+    results = []
+    accepted = []
+    batch_hashes = {}
+    saved_paths = []
+    stored = False
+    
+    try:
+        # Save everything first so extraction can start on all files at once
+        for file in files:
+            if not file or file.filename == '':
+                results.append({'filename': '', 'error': 'No file selected'})
+                continue
+            if not allowed_file(file.filename):
+                results.append({'filename': file.filename, 'error': 'Invalid file type'})
+                continue
+            
+            filename = secure_filename(file.filename)
+            unique_filename, file_path = build_upload_path(filename)
+            saved_paths.append(file_path)
+            started = time.perf_counter()
+            content_hash = save_upload(file, file_path)
+            save_metric = stage_metric('save', started, os.path.getsize(file_path))
+            
+            result = {'filename': file.filename}
+            results.append(result)
+            
+            # Skip files repeated within this batch, or already stored or in flight; claiming registers a job so
+            # that a concurrent upload of the same file is refused until this batch is stored
+            if content_hash in batch_hashes:
+                job_id, existing_doc_id, existing_job_id = None, None, None
+            else:
+                job_id, existing_doc_id, existing_job_id = claim_upload(file.filename, content_hash)
+            if job_id is None:
+                saved_paths.remove(file_path)
+                os.remove(file_path)
+                result['error'] = 'Document already uploaded'
+                result['doc_id'] = existing_doc_id
+                if existing_job_id:
+                    result['job_id'] = existing_job_id
+                if content_hash in batch_hashes:
+                    result['duplicate_of'] = batch_hashes[content_hash]
+                continue
+            batch_hashes[content_hash] = file.filename
+            result['job_id'] = job_id
+            
+            accepted.append({
+                'result': result,
+                'job_id': job_id,
+                'title': filename.rsplit('.', 1)[0],
+                'unique_filename': unique_filename,
+                'file_path': file_path,
+                'file_ext': filename.rsplit('.', 1)[1].lower(),
+                'content_hash': content_hash,
+                'metrics': [save_metric]
+            })
         
-        # Store in database
-        conn = sqlite3.connect(DATABASE)
-        c = conn.cursor()
+        # Extract text in parallel worker processes
+        for item in accepted:
+            update_job(item['job_id'], status='extracting', progress=10)
+        with ThreadPoolExecutor(max_workers=EXTRACT_PROCESSES) as extract_pool:
+            extract_futures = [extract_pool.submit(timed, extract_text_pages, item['file_path'], item['file_ext'],
+                                                   item['content_hash'])
+                               for item in accepted]
+            for item, future in zip(accepted, extract_futures):
+                try:
+                    item['pages'], duration_ms = future.result()
+                    item['text'] = ''.join(item['pages'])
+                    item['metrics'].append({'stage': 'extract', 'duration_ms': duration_ms,
+                                            'bytes': os.path.getsize(item['file_path']), 'pages': len(item['pages'])})
+                except ExtractionError as e:
+                    item['text'] = None
+                    item['result']['error'] = str(e)
+                    item['result']['extraction_error'] = e.to_dict()
+                    update_job(item['job_id'], status='failed', error=str(e), extraction_error=e.to_dict())
+        
+        extracted = [item for item in accepted if item['text']]
         
-        c.execute('''INSERT INTO documents 
-                     (title, filename, file_path, content, summary, topic, upload_date, file_type)
-                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                  (title, unique_filename, file_path, text_content, 
-                   analysis['summary'], analysis['topic'], 
-                   datetime.now().isoformat(), file_ext))
+        # Analyze with a bounded number of concurrent model calls
+        for item in extracted:
+            update_job(item['job_id'], status='analyzing', progress=40)
+        with ThreadPoolExecutor(max_workers=ANALYSIS_CONCURRENCY) as analysis_pool:
+            analyses = analysis_pool.map(lambda item: timed(analyze_tracked, item['text'], item['title']),
+                                         extracted)
+            for item, ((analysis, call_ids), duration_ms) in zip(extracted, analyses):
+                item['analysis'] = analysis
+                item['call_ids'] = call_ids
+                item['metrics'].append({'stage': 'analyze', 'duration_ms': duration_ms,
+                                        'bytes': len(item['text']), 'pages': None})
         
-        doc_id = c.lastrowid
+        for item in extracted:
+            item['terms'] = document_terms(item['text'])
         
-        # Store keywords
-        for keyword in analysis['keywords']:
-            c.execute('INSERT INTO keywords (doc_id, keyword) VALUES (?, ?)', (doc_id, keyword))
+        # Store every document as one write: all of them or none
+        def store_batch(c):
+            for item in extracted:
+                item['doc_id'] = store_document(c, item['title'], item['unique_filename'], item['file_path'],
+                                                item['text'], item['analysis'], item['file_ext'],
+                                                item['content_hash'], item['pages'], item['call_ids'],
+                                                item['terms'])
+                record_ingest_metrics(c, item['doc_id'], item['job_id'], item['metrics'])
+        for item in extracted:
+            update_job(item['job_id'], status='saving', progress=90)
+        try:
+            db_writer.run(store_batch)
+        except Exception as e:
+            print(f"Error storing batch: {e}")
+            return jsonify({'error': 'Could not store documents', 'results': results}), 500
+        stored = True
+    finally:
+        if not stored:
+            # Leave no orphaned files behind for a batch that was not stored
+            for file_path in saved_paths:
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+        # Release the claims of every file that did not make it into the database
+        for item in accepted:
+            if stored and item.get('text'):
+                update_job(item['job_id'], status='done', progress=100, doc_id=item['doc_id'],
+                           analysis=item['analysis'])
+            else:
+                with jobs_lock:
+                    if jobs.get(item['job_id'], {}).get('status') not in ('done', 'failed'):
+                        update_job(item['job_id'], status='failed', error='Could not store documents')
+    
+    for item in extracted:
+        item['result']['doc_id'] = item['doc_id']
+        item['result']['analysis'] = item['analysis']
+    
+    status = 201 if extracted else 400
+    return jsonify({
+        'message': f'{len(extracted)} of {len(files)} files uploaded successfully',
+        'results': results
+    }), status
+
+def chunked_upload_paths(upload_id):
+    """Return the (data, metadata) paths of a chunked upload session"""
+    base = os.path.join(PARTIAL_UPLOAD_FOLDER, upload_id)
+    return base + '.part', base + '.json'
+
+def get_chunked_upload(upload_id):
+    """Load a chunked upload session, rebuilding its hash state after a restart"""
+    with chunked_uploads_lock:
+        session = chunked_uploads.get(upload_id)
+        if session:
+            return session
         
-        # Store entities
-        for entity in analysis['entities']:
-            c.execute('INSERT INTO entities (doc_id, entity) VALUES (?, ?)', (doc_id, entity))
+        # Only plain hex ids map to files on disk
+        if not all(ch in '0123456789abcdef' for ch in upload_id):
+            return None
+        part_path, meta_path = chunked_upload_paths(upload_id)
+        if not os.path.exists(meta_path) or not os.path.exists(part_path):
+            return None
         
-        # Store topic as initial tag
-        c.execute('INSERT INTO tags (doc_id, tag) VALUES (?, ?)', (doc_id, analysis['topic']))
+        with open(meta_path) as meta_file:
+            session = json.load(meta_file)
         
-        conn.commit()
-        conn.close()
+        sha256 = hashlib.sha256()
+        with open(part_path, 'rb') as part:
+            for chunk in iter(lambda: part.read(UPLOAD_CHUNK_SIZE), b''):
+                sha256.update(chunk)
+        session['offset'] = os.path.getsize(part_path)
+        session['sha256'] = sha256
+        session['save_ms'] = 0  # time spent on chunks received before the restart is not known
+        session['lock'] = threading.Lock()
+        chunked_uploads[upload_id] = session
+        return session
+
+def expire_chunked_uploads():
+    """Delete chunked upload sessions idle for over CHUNKED_UPLOAD_TTL_HOURS; returns how many remain open"""
+    cutoff = time.time() - CHUNKED_UPLOAD_TTL_HOURS * 3600
+    remaining = 0
+    for upload_id in {name.rsplit('.', 1)[0] for name in os.listdir(PARTIAL_UPLOAD_FOLDER)}:
+        paths = [path for path in chunked_upload_paths(upload_id) if os.path.exists(path)]
+        try:
+            # Every appended chunk touches the .part file, so its mtime is the last activity
+            idle = all(os.path.getmtime(path) < cutoff for path in paths)
+        except OSError:
+            continue  # completed meanwhile
+        if not idle:
+            remaining += 1
+            continue
         
-        return jsonify({
-            'message': 'File uploaded successfully',
-            'doc_id': doc_id,
-            'analysis': analysis
-        }), 201
+        with chunked_uploads_lock:
+            session = chunked_uploads.get(upload_id)
+            if session is not None:
+                if not session['lock'].acquire(blocking=False):
+                    remaining += 1  # a chunk is arriving right now
+                    continue
+                session['expired'] = True
+                del chunked_uploads[upload_id]
+                session['lock'].release()
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+    return remaining
+
+def chunked_upload_status(session):
+    """Public view of a chunked upload session"""
+    return {
+        'upload_id': session['id'],
+        'filename': session['filename'],
+        'size': session['size'],
+        'offset': session['offset']
+    }
+
+@app.route('/api/uploads', methods=['POST'])
+def init_chunked_upload():
+    """Start a resumable chunked upload"""
+    data = request.get_json() or {}
+    original_name = data.get('filename', '')
+    size = data.get('size')
     
-    return jsonify({'error': 'Invalid file type'}), 400
+    if not original_name or not allowed_file(original_name):
+        return jsonify({'error': 'Invalid file type'}), 400
+    
+    if size is not None and (not isinstance(size, int) or size < 0 or size > MAX_CHUNKED_UPLOAD_SIZE):
+        return jsonify({'error': f'Size must be between 0 and {MAX_CHUNKED_UPLOAD_SIZE} bytes'}), 400
+    
+    if expire_chunked_uploads() >= MAX_CHUNKED_UPLOADS:
+        return jsonify({'error': 'Too many uploads in progress, retry later'}), 503
+    
+    upload_id = uuid.uuid4().hex
+    part_path, meta_path = chunked_upload_paths(upload_id)
+    session = {
+        'id': upload_id,
+        'filename': secure_filename(original_name),
+        'size': size,
+        'created_at': datetime.now().isoformat()
+    }
+    
+    open(part_path, 'wb').close()
+    with open(meta_path, 'w') as meta_file:
+        json.dump(session, meta_file)
+    
+    session.update(offset=0, sha256=hashlib.sha256(), save_ms=0, lock=threading.Lock())
+    with chunked_uploads_lock:
+        chunked_uploads[upload_id] = session
+    
+    return jsonify(chunked_upload_status(session)), 201
 
-@app.route('/api/documents', methods=['GET'])
-def get_documents():
-    """Get all documents with their metadata"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
-    c = conn.cursor()
+@app.route('/api/uploads/<upload_id>', methods=['GET'])
+def get_chunked_upload_status(upload_id):
+    """Report how many bytes of a chunked upload have been received"""
+    session = get_chunked_upload(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    return jsonify(chunked_upload_status(session))
+
+@app.route('/api/uploads/<upload_id>', methods=['PATCH'])
+def append_chunk(upload_id):
+    """Append a chunk (raw request body) at the offset given in ?offset="""
+    session = get_chunked_upload(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
     
-    c.execute('SELECT * FROM documents ORDER BY upload_date DESC')
-    docs = c.fetchall()
+    offset = request.args.get('offset', type=int)
     
-    documents = []
-    for doc in docs:
-        doc_dict = dict(doc)
-        doc_id = doc['id']
+    with session['lock']:
+        if session.get('expired'):
+            return jsonify({'error': 'Upload not found'}), 404
+        
+        # Chunks must arrive in order; the client resumes from the reported offset
+        if offset != session['offset']:
+            return jsonify(dict(chunked_upload_status(session), error='Offset mismatch')), 409
+        
+        part_path, _ = chunked_upload_paths(upload_id)
+        limit = session['size'] if session['size'] is not None else MAX_CHUNKED_UPLOAD_SIZE
+        # Hash into a copy so an interrupted chunk leaves the session untouched
+        sha256 = session['sha256'].copy()
+        written = 0
+        started = time.perf_counter()
+        with open(part_path, 'ab') as part:
+            try:
+                for chunk in iter(lambda: request.stream.read(UPLOAD_CHUNK_SIZE), b''):
+                    if session['offset'] + written + len(chunk) > limit:
+                        part.truncate(session['offset'])
+                        return jsonify({'error': 'Upload exceeds declared size'}), 413
+                    part.write(chunk)
+                    sha256.update(chunk)
+                    written += len(chunk)
+            except Exception:
+                part.truncate(session['offset'])
+                raise
         
-        # Get keywords
-        c.execute('SELECT keyword FROM keywords WHERE doc_id = ?', (doc_id,))
-        doc_dict['keywords'] = [row['keyword'] for row in c.fetchall()]
+        session['sha256'] = sha256
+        session['offset'] += written
+        # The save stage of a chunked upload is the time spent receiving and writing all of its chunks
+        session['save_ms'] += (time.perf_counter() - started) * 1000
+    
+    return jsonify(chunked_upload_status(session))
+
+@app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+def complete_chunked_upload(upload_id):
+    """Finish a chunked upload and queue it for processing"""
+    session = get_chunked_upload(upload_id)
+    if not session:
+        return jsonify({'error': 'Upload not found'}), 404
+    
+    with session['lock']:
+        if session.get('expired'):
+            return jsonify({'error': 'Upload not found'}), 404
+        
+        if session['size'] is not None and session['offset'] != session['size']:
+            return jsonify(dict(chunked_upload_status(session), error='Upload incomplete')), 409
         
-        # Get entities
-        c.execute('SELECT entity FROM entities WHERE doc_id = ?', (doc_id,))
-        doc_dict['entities'] = [row['entity'] for row in c.fetchall()]
+        if not ingest_slots.acquire(blocking=False):
+            return jsonify({'error': 'Ingestion queue is full, retry later'}), 503
         
-        # Get tags
-        c.execute('SELECT tag FROM tags WHERE doc_id = ?', (doc_id,))
-        doc_dict['tags'] = [row['tag'] for row in c.fetchall()]
+        part_path, meta_path = chunked_upload_paths(upload_id)
+        content_hash = session['sha256'].hexdigest()
+        filename = session['filename']
+        save_metric = {'stage': 'save', 'duration_ms': session['save_ms'], 'bytes': session['offset'], 'pages': None}
         
-        # Don't send full content in list view
-        doc_dict.pop('content', None)
+        with chunked_uploads_lock:
+            chunked_uploads.pop(upload_id, None)
+        os.remove(meta_path)
         
-        documents.append(doc_dict)
+        job_id, existing_doc_id, existing_job_id = claim_upload(filename, content_hash)
+        if job_id is None:
+            ingest_slots.release()
+            os.remove(part_path)
+            return jsonify({
+                'error': 'Document already uploaded',
+                'doc_id': existing_doc_id,
+                'job_id': existing_job_id
+            }), 409
+        
+        unique_filename, file_path = build_upload_path(filename)
+        os.replace(part_path, file_path)
+    
+    ingest_executor.submit(process_upload, job_id, file_path, unique_filename, filename, content_hash,
+                           [save_metric], time.perf_counter())
+    
+    return jsonify({
+        'message': 'File accepted for processing',
+        'job_id': job_id,
+        'status_url': f'/api/jobs/{job_id}'
+    }), 202
+
+@app.route('/api/analysis/status', methods=['GET'])
+def get_analysis_status():
+    """Report queued and in-flight AI calls against the shared limits"""
+    return jsonify(get_analysis_service().status())
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Get the status of an ingestion job"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+        job = dict(job) if job else None
+    
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return jsonify(job)
+
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def stream_job_events(job_id):
+    """Stream a job's stage transitions and the model's output as server-sent events until it finishes"""
+    with jobs_lock:
+        if job_id not in jobs:
+            return jsonify({'error': 'Job not found'}), 404
+    
+    # Reconnecting clients resume after the last event they saw
+    try:
+        position = int(request.headers.get('Last-Event-ID', -1)) + 1
+    except ValueError:
+        position = 0
+    
+    def generate():
+        nonlocal position
+        while True:
+            with jobs_changed:
+                if job_id in job_events and position >= len(job_events[job_id]):
+                    jobs_changed.wait(JOB_EVENTS_KEEPALIVE_SECONDS)
+                if job_id not in job_events:
+                    return
+                events = job_events[job_id][position:]
+            
+            if not events:
+                yield ': keep-alive\n\n'
+                continue
+            for event in events:
+                yield f"id: {position}\nevent: {event['event']}\ndata: {json.dumps(event['data'])}\n\n"
+                position += 1
+                if event['event'] in ('done', 'failed'):
+                    return
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/documents', methods=['GET'])
+def get_documents():
+    """Get all documents with their metadata"""
+    conn = get_db()
+    c = conn.cursor()
+    
+    documents = list_documents(c)
     
-    conn.close()
     return jsonify(documents)
 
+# Columns of the list view (everything except the full content)
+DOCUMENT_LIST_COLUMNS = ('id', 'title', 'filename', 'file_path', 'summary', 'topic', 'upload_date', 'file_type',
+                         'content_hash', 'analysis_status')
+
+def list_documents(c, where='', params=()):
+    """Documents with their keywords, entities and tags in a single query, newest first
+    
+    Each document's related rows are aggregated into JSON arrays (in insertion order) by correlated subqueries,
+    which the doc_id indexes answer for the selected documents only, instead of three lookups per document.
+    """
+    columns = ', '.join(f'd.{column}' for column in DOCUMENT_LIST_COLUMNS)
+    c.execute(f'''SELECT {columns},
+                         (SELECT json_group_array(keyword)
+                          FROM (SELECT keyword FROM keywords WHERE doc_id = d.id ORDER BY id)) AS keywords,
+                         (SELECT json_group_array(entity)
+                          FROM (SELECT entity FROM entities WHERE doc_id = d.id ORDER BY id)) AS entities,
+                         (SELECT json_group_array(tag)
+                          FROM (SELECT tag FROM tags WHERE doc_id = d.id ORDER BY id)) AS tags
+                  FROM documents d
+                  {where}
+                  ORDER BY d.upload_date DESC''', params)
+    
+    documents = []
+    for row in c.fetchall():
+        doc = dict(zip(DOCUMENT_LIST_COLUMNS + ('keywords', 'entities', 'tags'), row))
+        for field in ('keywords', 'entities', 'tags'):
+            doc[field] = json.loads(doc[field]) if doc[field] else []
+        documents.append(doc)
+    return documents
+
 @app.route('/api/documents/<int:doc_id>', methods=['GET'])
 def get_document(doc_id):
-    """Get a specific document with full content"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    """Get a specific document (full content only with ?content=true, see /pages)"""
+    conn = get_db()
     c = conn.cursor()
+    c.row_factory = sqlite3.Row
     
     c.execute('SELECT * FROM documents WHERE id = ?', (doc_id,))
     doc = c.fetchone()
     
     if not doc:
-        conn.close()
         return jsonify({'error': 'Document not found'}), 404
     
     doc_dict = dict(doc)
     
+    if request.args.get('content', '').lower() == 'true':
+        doc_dict['content'] = load_content(c, doc_id)
+    
+    c.execute('SELECT COUNT(*) FROM document_pages WHERE doc_id = ?', (doc_id,))
+    doc_dict['page_count'] = c.fetchone()[0]
+    
     # Get keywords
     c.execute('SELECT keyword FROM keywords WHERE doc_id = ?', (doc_id,))
     doc_dict['keywords'] = [row['keyword'] for row in c.fetchall()]
@@ -291,13 +2683,179 @@ def get_document(doc_id):
     c.execute('SELECT linked_doc_id FROM document_links WHERE doc_id = ?', (doc_id,))
     doc_dict['linked_docs'] = [row['linked_doc_id'] for row in c.fetchall()]
     
-    conn.close()
     return jsonify(doc_dict)
 
+@app.route('/api/documents/<int:doc_id>/pages', methods=['GET'])
+def get_document_pages(doc_id):
+    """Get the text of a range of pages (?from=&to=, 1-based and inclusive)"""
+    conn = get_db()
+    c = conn.cursor()
+    c.row_factory = sqlite3.Row
+    
+    c.execute('SELECT id FROM documents WHERE id = ?', (doc_id,))
+    if not c.fetchone():
+        return jsonify({'error': 'Document not found'}), 404
+    
+    c.execute('SELECT COUNT(*) FROM document_pages WHERE doc_id = ?', (doc_id,))
+    page_count = c.fetchone()[0]
+    
+    first = max(request.args.get('from', 1, type=int), 1)
+    last = request.args.get('to', first + MAX_PAGES_PER_REQUEST - 1, type=int)
+    last = min(last, first + MAX_PAGES_PER_REQUEST - 1, page_count)
+    
+    c.execute('''SELECT page_number, char_offset, body FROM document_pages
+                 WHERE doc_id = ? AND page_number BETWEEN ? AND ?
+                 ORDER BY page_number''', (doc_id, first, last))
+    pages = [{'page': row['page_number'], 'offset': row['char_offset'], 'text': decompress_content(row['body'])}
+             for row in c.fetchall()]
+    
+    return jsonify({
+        'doc_id': doc_id,
+        'page_count': page_count,
+        'from': first,
+        'to': last,
+        'pages': pages
+    })
+
+@app.route('/api/documents/<int:doc_id>/ingest-stats', methods=['GET'])
+def get_ingest_stats(doc_id):
+    """Get the per-stage ingestion timings recorded for a document"""
+    conn = get_db()
+    c = conn.cursor()
+    c.row_factory = sqlite3.Row
+    
+    c.execute('''SELECT stage, duration_ms, bytes, pages, recorded_at FROM ingest_metrics
+                 WHERE doc_id = ? ORDER BY id''', (doc_id,))
+    stages = [dict(row) for row in c.fetchall()]
+    
+    if not stages:
+        return jsonify({'error': 'No ingest metrics for document'}), 404
+    
+    return jsonify({
+        'doc_id': doc_id,
+        'total_ms': sum(stage['duration_ms'] for stage in stages),
+        'stages': stages
+    })
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+@app.route('/api/ingest-stats', methods=['GET'])
+def get_ingest_percentiles():
+    """Aggregate ingestion timings per stage (?days= limits to recent uploads, default 7)"""
+    days = request.args.get('days', 7, type=float)
+    since = (datetime.now() - timedelta(days=days)).isoformat()
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''SELECT stage, duration_ms, bytes, pages FROM ingest_metrics
+                 WHERE recorded_at >= ? ORDER BY stage, duration_ms''', (since,))
+    rows = c.fetchall()
+    
+    by_stage = {}
+    for stage, duration_ms, size, pages in rows:
+        entry = by_stage.setdefault(stage, {'durations': [], 'bytes': 0, 'pages': 0})
+        entry['durations'].append(duration_ms)
+        entry['bytes'] += size or 0
+        entry['pages'] += pages or 0
+    
+    stats = {}
+    for stage, entry in by_stage.items():
+        durations = entry['durations']
+        stats[stage] = {
+            'count': len(durations),
+            'mean_ms': sum(durations) / len(durations),
+            'p50_ms': percentile(durations, 50),
+            'p90_ms': percentile(durations, 90),
+            'p95_ms': percentile(durations, 95),
+            'p99_ms': percentile(durations, 99),
+            'max_ms': durations[-1],
+            'total_bytes': entry['bytes'],
+            'total_pages': entry['pages']
+        }
+    
+    return jsonify({'since': since, 'stages': stats})
+
+@app.route('/api/analysis/usage', methods=['GET'])
+def get_analysis_usage():
+    """Aggregate model call tokens, cost and latency (?group=day|document, ?days= window, default 30)"""
+    group = request.args.get('group', 'day')
+    if group not in ('day', 'document'):
+        return jsonify({'error': "group must be 'day' or 'document'"}), 400
+    days = request.args.get('days', 30, type=float)
+    since = (datetime.now() - timedelta(days=days)).isoformat()
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''SELECT substr(analysis_calls.created_at, 1, 10), analysis_calls.doc_id, documents.title,
+                        input_tokens, output_tokens, cache_creation_tokens, cache_read_tokens, latency_ms, cost_usd
+                 FROM analysis_calls LEFT JOIN documents ON documents.id = analysis_calls.doc_id
+                 WHERE analysis_calls.created_at >= ? ORDER BY latency_ms''', (since,))
+    rows = c.fetchall()
+    
+    groups = {}
+    for day, doc_id, title, input_tokens, output_tokens, cache_creation, cache_read, latency_ms, cost in rows:
+        key = day if group == 'day' else doc_id
+        entry = groups.setdefault(key, {'calls': 0, 'input_tokens': 0, 'output_tokens': 0,
+                                        'cache_creation_tokens': 0, 'cache_read_tokens': 0, 'cost_usd': 0.0,
+                                        'latencies': []})
+        if group == 'document':
+            entry['title'] = title
+        entry['calls'] += 1
+        entry['input_tokens'] += input_tokens
+        entry['output_tokens'] += output_tokens
+        entry['cache_creation_tokens'] += cache_creation
+        entry['cache_read_tokens'] += cache_read
+        entry['cost_usd'] += cost or 0
+        if latency_ms is not None:
+            entry['latencies'].append(latency_ms)
+    
+    usage = []
+    for key, entry in groups.items():
+        latencies = entry.pop('latencies')
+        entry[group if group == 'day' else 'doc_id'] = key
+        entry['mean_latency_ms'] = sum(latencies) / len(latencies) if latencies else None
+        entry['p50_latency_ms'] = percentile(latencies, 50)
+        entry['p95_latency_ms'] = percentile(latencies, 95)
+        usage.append(entry)
+    if group == 'day':
+        usage.sort(key=lambda entry: entry['day'])
+    else:
+        usage.sort(key=lambda entry: entry['cost_usd'], reverse=True)
+    
+    return jsonify({
+        'since': since,
+        'group': group,
+        'total_cost_usd': sum(entry['cost_usd'] for entry in usage),
+        'total_calls': len(rows),
+        'usage': usage
+    })
+
+def remove_document(c, doc_id, terms):
+    """Delete a document's rows, dependent rows first (foreign keys are enforced)
+    
+    `terms` are the document's terms (from document_terms), read before queueing the delete.
+    """
+    c.execute('DELETE FROM keywords WHERE doc_id = ?', (doc_id,))
+    c.execute('DELETE FROM entities WHERE doc_id = ?', (doc_id,))
+    c.execute('DELETE FROM tags WHERE doc_id = ?', (doc_id,))
+    c.execute('DELETE FROM notes WHERE doc_id = ?', (doc_id,))
+    c.execute('DELETE FROM document_pages WHERE doc_id = ?', (doc_id,))
+    c.execute('DELETE FROM ingest_metrics WHERE doc_id = ?', (doc_id,))
+    # Spend stays on the books, unattributed
+    c.execute('UPDATE analysis_calls SET doc_id = NULL WHERE doc_id = ?', (doc_id,))
+    c.execute('DELETE FROM document_links WHERE doc_id = ? OR linked_doc_id = ?', (doc_id, doc_id))
+    c.execute('DELETE FROM documents WHERE id = ?', (doc_id,))
+    update_corpus_terms(c, terms, -1)
+
 @app.route('/api/documents/<int:doc_id>', methods=['DELETE'])
 def delete_document(doc_id):
     """Delete a document and its file"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     c = conn.cursor()
     
     # Get file path
@@ -305,63 +2863,74 @@ def delete_document(doc_id):
     result = c.fetchone()
     
     if not result:
-        conn.close()
         return jsonify({'error': 'Document not found'}), 404
     
     file_path = result[0]
     
+    # Tokenize here rather than on the writer thread, where it would hold up every other write
+    terms = document_terms(load_content(c, doc_id) or '')
+    db_writer.run(remove_document, doc_id, terms)
+    
     # Delete file
     if os.path.exists(file_path):
         os.remove(file_path)
     
-    # Delete from database
-    c.execute('DELETE FROM documents WHERE id = ?', (doc_id,))
-    c.execute('DELETE FROM keywords WHERE doc_id = ?', (doc_id,))
-    c.execute('DELETE FROM entities WHERE doc_id = ?', (doc_id,))
-    c.execute('DELETE FROM tags WHERE doc_id = ?', (doc_id,))
-    c.execute('DELETE FROM notes WHERE doc_id = ?', (doc_id,))
-    c.execute('DELETE FROM document_links WHERE doc_id = ? OR linked_doc_id = ?', (doc_id, doc_id))
-    
-    conn.commit()
-    conn.close()
-    
     return jsonify({'message': 'Document deleted successfully'})
 
 @app.route('/api/documents/<int:doc_id>/regenerate', methods=['POST'])
 def regenerate_analysis(doc_id):
     """Regenerate AI analysis for a document"""
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
+    c.row_factory = sqlite3.Row
     
-    c.execute('SELECT title, content FROM documents WHERE id = ?', (doc_id,))
+    c.execute('SELECT title FROM documents WHERE id = ?', (doc_id,))
     doc = c.fetchone()
     
     if not doc:
-        conn.close()
         return jsonify({'error': 'Document not found'}), 404
+    content = load_content(c, doc_id) or ''
     
-    # Analyze with AI
-    analysis = analyze_document_with_ai(doc['content'], doc['title'])
+    # Analyze with AI (?force=true bypasses the analysis cache, ?backend= picks the analyzer)
+    force = request.args.get('force', '').lower() == 'true'
+    backend = request.args.get('backend')
+    if backend is not None and backend not in ANALYZERS and backend != 'auto':
+        return jsonify({'error': f"Unknown analyzer backend: {backend}"}), 400
+    analysis, call_ids = analyze_tracked(content, doc['title'], force=force, backend=backend)
     
-    # Update document
-    c.execute('UPDATE documents SET summary = ?, topic = ? WHERE id = ?',
-              (analysis['summary'], analysis['topic'], doc_id))
+    def save_analysis(c):
+        attribute_analysis_calls(c, doc_id, call_ids)
+        # Keep the current analysis rather than overwrite it with a stand-in
+        if not analysis.get('pending'):
+            apply_analyses(c, {doc_id: analysis})
+    db_writer.run(save_analysis)
     
-    # Clear and update keywords
-    c.execute('DELETE FROM keywords WHERE doc_id = ?', (doc_id,))
-    for keyword in analysis['keywords']:
-        c.execute('INSERT INTO keywords (doc_id, keyword) VALUES (?, ?)', (doc_id, keyword))
+    if analysis.get('pending'):
+        return jsonify({'error': 'AI analysis is temporarily unavailable; try again later'}), 503
     
-    # Clear and update entities
-    c.execute('DELETE FROM entities WHERE doc_id = ?', (doc_id,))
-    for entity in analysis['entities']:
-        c.execute('INSERT INTO entities (doc_id, entity) VALUES (?, ?)', (doc_id, entity))
+    return jsonify(analysis)
+
+@app.route('/api/documents/reanalyze', methods=['POST'])
+def bulk_reanalyze():
+    """Reanalyze many documents (JSON doc_ids, default all) through batch submissions"""
+    data = request.get_json(silent=True) or {}
+    doc_ids = data.get('doc_ids')
     
-    conn.commit()
-    conn.close()
+    if doc_ids is None:
+        conn = get_db()
+        c = conn.cursor()
+        c.execute('SELECT id FROM documents ORDER BY id')
+        doc_ids = [row[0] for row in c.fetchall()]
+    elif not isinstance(doc_ids, list) or not all(isinstance(doc_id, int) for doc_id in doc_ids):
+        return jsonify({'error': 'doc_ids must be a list of document ids'}), 400
     
-    return jsonify(analysis)
+    job_id = start_reanalysis(doc_ids)
+    
+    return jsonify({
+        'message': f'Reanalyzing {len(doc_ids)} documents',
+        'job_id': job_id,
+        'status_url': f'/api/jobs/{job_id}'
+    }), 202
 
 @app.route('/api/documents/<int:doc_id>/notes', methods=['POST'])
 def add_note(doc_id):
@@ -372,15 +2941,8 @@ def add_note(doc_id):
     if not note_text:
         return jsonify({'error': 'Note text required'}), 400
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
-    
-    c.execute('INSERT INTO notes (doc_id, note_text, timestamp) VALUES (?, ?, ?)',
-              (doc_id, note_text, datetime.now().isoformat()))
-    
-    note_id = c.lastrowid
-    conn.commit()
-    conn.close()
+    note_id = db_writer.run(lambda c: c.execute('INSERT INTO notes (doc_id, note_text, timestamp) VALUES (?, ?, ?)',
+                                                (doc_id, note_text, datetime.now().isoformat())).lastrowid)
     
     return jsonify({'id': note_id, 'message': 'Note added successfully'}), 201
 
@@ -393,19 +2955,17 @@ def add_tag(doc_id):
     if not tag:
         return jsonify({'error': 'Tag required'}), 400
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
+    def insert_tag(c):
+        # Check if tag already exists
+        c.execute('SELECT id FROM tags WHERE doc_id = ? AND tag = ?', (doc_id, tag))
+        if c.fetchone():
+            return False
+        c.execute('INSERT INTO tags (doc_id, tag) VALUES (?, ?)', (doc_id, tag))
+        return True
     
-    # Check if tag already exists
-    c.execute('SELECT id FROM tags WHERE doc_id = ? AND tag = ?', (doc_id, tag))
-    if c.fetchone():
-        conn.close()
+    if not db_writer.run(insert_tag):
         return jsonify({'message': 'Tag already exists'}), 200
     
-    c.execute('INSERT INTO tags (doc_id, tag) VALUES (?, ?)', (doc_id, tag))
-    conn.commit()
-    conn.close()
-    
     return jsonify({'message': 'Tag added successfully'}), 201
 
 @app.route('/api/documents/<int:doc_id>/links', methods=['POST'])
@@ -417,21 +2977,19 @@ def link_documents(doc_id):
     if not linked_doc_id:
         return jsonify({'error': 'Linked document ID required'}), 400
     
-    conn = sqlite3.connect(DATABASE)
-    c = conn.cursor()
+    def insert_link(c):
+        # Check if link already exists
+        c.execute('SELECT id FROM document_links WHERE doc_id = ? AND linked_doc_id = ?',
+                  (doc_id, linked_doc_id))
+        if c.fetchone():
+            return False
+        c.execute('INSERT INTO document_links (doc_id, linked_doc_id) VALUES (?, ?)',
+                  (doc_id, linked_doc_id))
+        return True
     
-    # Check if link already exists
-    c.execute('SELECT id FROM document_links WHERE doc_id = ? AND linked_doc_id = ?',
-              (doc_id, linked_doc_id))
-    if c.fetchone():
-        conn.close()
+    if not db_writer.run(insert_link):
         return jsonify({'message': 'Link already exists'}), 200
     
-    c.execute('INSERT INTO document_links (doc_id, linked_doc_id) VALUES (?, ?)',
-              (doc_id, linked_doc_id))
-    conn.commit()
-    conn.close()
-    
     return jsonify({'message': 'Documents linked successfully'}), 201
 
 @app.route('/api/search', methods=['GET'])
@@ -440,62 +2998,36 @@ def search_documents():
     query = request.args.get('q', '').lower()
     tag_filter = request.args.get('tag', '')
     
-    conn = sqlite3.connect(DATABASE)
-    conn.row_factory = sqlite3.Row
+    conn = get_db()
     c = conn.cursor()
     
+    # Matches are found with uncorrelated IN subqueries, each evaluated once
     if tag_filter:
-        c.execute('''SELECT DISTINCT d.* FROM documents d
-                     JOIN tags t ON d.id = t.doc_id
-                     WHERE t.tag = ?
-                     ORDER BY d.upload_date DESC''', (tag_filter,))
+        documents = list_documents(c, 'WHERE d.id IN (SELECT doc_id FROM tags WHERE tag = ?)', (tag_filter,))
     elif query:
-        c.execute('''SELECT DISTINCT d.* FROM documents d
-                     LEFT JOIN keywords k ON d.id = k.doc_id
-                     LEFT JOIN tags t ON d.id = t.doc_id
-                     WHERE LOWER(d.title) LIKE ? 
-                     OR LOWER(d.summary) LIKE ?
-                     OR LOWER(k.keyword) LIKE ?
-                     OR LOWER(t.tag) LIKE ?
-                     ORDER BY d.upload_date DESC''',
-                  (f'%{query}%', f'%{query}%', f'%{query}%', f'%{query}%'))
+        pattern = f'%{query}%'
+        documents = list_documents(c, '''WHERE LOWER(d.title) LIKE ?
+                                         OR LOWER(d.summary) LIKE ?
+                                         OR d.id IN (SELECT doc_id FROM keywords WHERE LOWER(keyword) LIKE ?)
+                                         OR d.id IN (SELECT doc_id FROM tags WHERE LOWER(tag) LIKE ?)''',
+                                   (pattern, pattern, pattern, pattern))
     else:
-        c.execute('SELECT * FROM documents ORDER BY upload_date DESC')
-    
-    docs = c.fetchall()
-    
-    documents = []
-    for doc in docs:
-        doc_dict = dict(doc)
-        doc_id = doc['id']
-        
-        c.execute('SELECT keyword FROM keywords WHERE doc_id = ?', (doc_id,))
-        doc_dict['keywords'] = [row['keyword'] for row in c.fetchall()]
-        
-        c.execute('SELECT entity FROM entities WHERE doc_id = ?', (doc_id,))
-        doc_dict['entities'] = [row['entity'] for row in c.fetchall()]
-        
-        c.execute('SELECT tag FROM tags WHERE doc_id = ?', (doc_id,))
-        doc_dict['tags'] = [row['tag'] for row in c.fetchall()]
-        
-        doc_dict.pop('content', None)
-        documents.append(doc_dict)
+        documents = list_documents(c)
     
-    conn.close()
     return jsonify(documents)
 
 @app.route('/api/tags', methods=['GET'])
 def get_all_tags():
     """Get all unique tags"""
-    conn = sqlite3.connect(DATABASE)
+    conn = get_db()
     c = conn.cursor()
     
     c.execute('SELECT DISTINCT tag FROM tags ORDER BY tag')
     tags = [row[0] for row in c.fetchall()]
     
-    conn.close()
     return jsonify(tags)
 
 if __name__ == '__main__':
     init_db()
+    init_extraction_cache()
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,126 @@
+"""Benchmark the document list and search endpoints against synthetic corpora of growing size
+
+Usage:
+    python benchmark_queries.py [--sizes 1000 5000 20000] [--repeat 5] [--compare]
+
+For each corpus size a fresh database is seeded with documents carrying 8 keywords, 8 entities and 2 tags,
+then GET /api/documents, /api/search?q= and /api/search?tag= are timed through the Flask test client. The
+SQL statements issued per request (apart from the PRAGMAs that set up each connection) are counted as well:
+they should stay constant, and the time per document roughly flat, as the corpus grows. --compare also times
+the previous per-document lookup for reference, next to the current listing query called the same way
+(without the HTTP and JSON overhead of the endpoints).
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+
+import app
+
+statements = 0
+real_connect = sqlite3.connect
+
+def counting_connect(*args, **kwargs):
+    """sqlite3.connect that counts the statements run on the connection, leaving out its PRAGMA setup"""
+    conn = real_connect(*args, **kwargs)
+
+    def count(statement):
+        global statements
+        if not statement.lstrip().upper().startswith('PRAGMA'):
+            statements += 1
+    conn.set_trace_callback(count)
+    return conn
+
+def parse_args():
+    """Parse command-line options"""
+    parser = argparse.ArgumentParser(description='Benchmark document list and search queries')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000],
+                        help='Corpus sizes to benchmark (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed requests per endpoint (default: %(default)s)')
+    parser.add_argument('--compare', action='store_true',
+                        help='Also time the per-document lookup used before (slow on large corpora)')
+    return parser.parse_args()
+
+def seed(database, size):
+    """Fill a fresh database with `size` synthetic documents and their keywords, entities and tags"""
+    rng = random.Random(size)
+    vocabulary = [f'term{i}' for i in range(2000)]
+    topics = [f'topic{i}' for i in range(50)]
+
+    conn = real_connect(database)
+    c = conn.cursor()
+    c.executemany('''INSERT INTO documents (id, title, filename, file_path, summary, topic, upload_date, file_type,
+                                            content_hash)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                  [(i, f'Document {i}', f'doc{i}.txt', f'uploads/doc{i}.txt',
+                    f'Summary of document {i} about {rng.choice(vocabulary)}', rng.choice(topics),
+                    f'2024-01-01T00:00:{i:09d}', 'txt', f'{i:064x}') for i in range(1, size + 1)])
+    c.executemany('INSERT INTO document_pages (doc_id, page_number, char_offset, body, length) VALUES (?, 1, 0, ?, ?)',
+                  [(i, *app.compress_content(f'Body of document {i}. ' * 100)) for i in range(1, size + 1)])
+    c.executemany('INSERT INTO keywords (doc_id, keyword) VALUES (?, ?)',
+                  [(i, word) for i in range(1, size + 1) for word in rng.sample(vocabulary, 8)])
+    c.executemany('INSERT INTO entities (doc_id, entity) VALUES (?, ?)',
+                  [(i, word.title()) for i in range(1, size + 1) for word in rng.sample(vocabulary, 8)])
+    c.executemany('INSERT INTO tags (doc_id, tag) VALUES (?, ?)',
+                  [(i, tag) for i in range(1, size + 1) for tag in rng.sample(topics, 2)])
+    conn.commit()
+    conn.close()
+
+def legacy_list(database):
+    """The previous listing: one query for the documents, then three per document"""
+    conn = sqlite3.connect(database)
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute('SELECT * FROM documents ORDER BY upload_date DESC')
+    documents = []
+    for doc in c.fetchall():
+        doc_dict = dict(doc)
+        for table, column in (('keywords', 'keyword'), ('entities', 'entity'), ('tags', 'tag')):
+            c.execute(f'SELECT {column} FROM {table} WHERE doc_id = ?', (doc['id'],))
+            doc_dict[table] = [row[column] for row in c.fetchall()]
+        documents.append(doc_dict)
+    conn.close()
+    return documents
+
+def measure(func, repeat):
+    """Median wall time in ms and statements issued per call"""
+    global statements
+    durations = []
+    for _ in range(repeat):
+        statements = 0
+        started = time.perf_counter()
+        func()
+        durations.append((time.perf_counter() - started) * 1000)
+    return statistics.median(durations), statements
+
+def main():
+    args = parse_args()
+    sqlite3.connect = counting_connect
+    client = app.app.test_client()
+
+    endpoints = [
+        ('list', lambda: client.get('/api/documents')),
+        ('search', lambda: client.get('/api/search?q=term1')),
+        ('tag', lambda: client.get('/api/search?tag=topic7'))
+    ]
+    print(f"{'docs':>7} {'endpoint':>8} {'statements':>10} {'median ms':>10} {'us/doc':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            app.DATABASE = os.path.join(directory, f'bench_{size}.db')
+            app.init_db()
+            seed(app.DATABASE, size)
+
+            runs = list(endpoints)
+            if args.compare:
+                runs.append(('query', lambda: app.list_documents(app.connect_db().cursor())))
+                runs.append(('legacy', lambda: legacy_list(app.DATABASE)))
+            for name, func in runs:
+                func()  # warm the page cache
+                median_ms, count = measure(func, args.repeat)
+                print(f"{size:>7} {name:>8} {count:>10} {median_ms:>10.1f} {median_ms * 1000 / size:>8.1f}")
+
+if __name__ == '__main__':
+    main()
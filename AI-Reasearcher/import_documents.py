@@ -0,0 +1,208 @@
+"""Bulk import a directory tree of PDFs and text files into research_hub.db
+
+Usage:
+    python import_documents.py /path/to/share [--analyzer local] [--batch-size 500]
+
+Files are extracted in parallel and written in large transactions. Progress is
+checkpointed after every batch, so an interrupted import picks up where it
+stopped when run again with the same checkpoint file.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+PENDING_ANALYSIS = {
+    "summary": "Analysis pending",
+    "keywords": [],
+    "entities": [],
+    "topic": "General",
+    "pending": True
+}
+
+def parse_args():
+    """Parse command-line options"""
+    parser = argparse.ArgumentParser(description='Bulk import documents into the research hub database')
+    parser.add_argument('directory', help='Directory tree to import')
+    parser.add_argument('--db', default=app.DATABASE, help='SQLite database file (default: %(default)s)')
+    parser.add_argument('--batch-size', type=int, default=500, help='Documents per transaction (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=app.EXTRACT_PROCESSES,
+                        help='Parallel extraction workers (default: %(default)s)')
+    parser.add_argument('--checkpoint', default='.import_checkpoint.json',
+                        help='Checkpoint file used to resume (default: %(default)s)')
+    parser.add_argument('--analyzer', choices=sorted(app.ANALYZERS) + ['auto', 'none'], default='local',
+                        help="Analyzer backend to run during the import; 'none' stores a pending placeholder "
+                             "(default: %(default)s)")
+    return parser.parse_args()
+
+def find_files(directory):
+    """Yield importable files under a directory, in a stable order"""
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if app.allowed_file(name):
+                yield os.path.join(root, name)
+
+def load_checkpoint(path):
+    """Return the set of source paths already handled by a previous run"""
+    if not os.path.exists(path):
+        return set()
+    with open(path) as checkpoint_file:
+        return set(json.load(checkpoint_file)['done'])
+
+def save_checkpoint(path, done):
+    """Atomically write the set of handled source paths"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as checkpoint_file:
+        json.dump({'done': sorted(done), 'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S')}, checkpoint_file)
+    os.replace(tmp_path, path)
+
+def copy_into_uploads(source_path, filename):
+    """Place a source file in the upload folder, hard-linking when possible"""
+    unique_filename, file_path = app.build_upload_path(filename)
+    try:
+        os.link(source_path, file_path)
+    except OSError:
+        shutil.copy2(source_path, file_path)
+    return unique_filename, file_path
+
+def extract_file(source_path):
+    """Hash and extract one file; returns a record for the writer"""
+    filename = app.secure_filename(os.path.basename(source_path))
+    record = {
+        'source_path': source_path,
+        'filename': filename,
+        'file_ext': filename.rsplit('.', 1)[1].lower(),
+        'size': os.path.getsize(source_path)
+    }
+    try:
+        record['content_hash'] = app.file_sha256(source_path)
+        record['pages'] = app.extract_text_pages(source_path, record['file_ext'], record['content_hash'])
+        record['terms'] = app.document_terms(''.join(record['pages']))
+    except app.ExtractionError as e:
+        record['error'] = e.to_dict()
+    except OSError as e:
+        record['error'] = {'reason': 'unreadable', 'message': str(e)}
+    return record
+
+def write_batch(conn, records):
+    """Store a batch of extracted records in one transaction; returns the number stored"""
+    c = conn.cursor()
+    seen = set()
+    new_records = []
+    copied = []
+
+    # Skip files already in the database or repeated within this batch
+    for record in records:
+        if 'error' in record:
+            continue
+        c.execute('SELECT id FROM documents WHERE content_hash = ? LIMIT 1', (record['content_hash'],))
+        if c.fetchone() or record['content_hash'] in seen:
+            record['duplicate'] = True
+            continue
+        seen.add(record['content_hash'])
+        new_records.append(record)
+
+    try:
+        # Copy before the first insert opens the transaction, so a slow copy never holds the write lock
+        for record in new_records:
+            record['unique_filename'], record['file_path'] = copy_into_uploads(record['source_path'],
+                                                                               record['filename'])
+            copied.append(record['file_path'])
+
+        for record in new_records:
+            text_content = ''.join(record['pages'])
+            app.store_document(c, record['filename'].rsplit('.', 1)[0], record['unique_filename'],
+                               record['file_path'], text_content, record.get('analysis', PENDING_ANALYSIS),
+                               record['file_ext'], record['content_hash'], record['pages'], record.get('call_ids'),
+                               record['terms'])
+
+        conn.commit()
+    except BaseException:
+        # Leave no orphaned copies behind for a batch that was not committed
+        conn.rollback()
+        for file_path in copied:
+            os.remove(file_path)
+        raise
+
+    return len(copied)
+
+def main():
+    args = parse_args()
+
+    app.DATABASE = args.db
+    app.init_db()
+    app.init_extraction_cache()
+
+    done = load_checkpoint(args.checkpoint)
+    # Absolute paths keep the checkpoint valid regardless of the working directory
+    pending = [path for path in find_files(os.path.abspath(args.directory)) if path not in done]
+    total = len(pending)
+    if done:
+        print(f"Resuming: {len(done)} files already handled, {total} remaining")
+    else:
+        print(f"Importing {total} files from {args.directory}")
+
+    conn = app.connect_db(args.db)
+    started = time.monotonic()
+    processed = stored = failed = duplicates = pages = bytes_read = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            for start in range(0, total, args.batch_size):
+                batch = pending[start:start + args.batch_size]
+                records = list(pool.map(extract_file, batch))
+
+                if args.analyzer != 'none':
+                    to_analyze = [record for record in records if 'error' not in record]
+                    with ThreadPoolExecutor(max_workers=app.ANALYSIS_CONCURRENCY) as analysis_pool:
+                        analyses = analysis_pool.map(
+                            lambda record: app.analyze_tracked(''.join(record['pages']),
+                                                               record['filename'].rsplit('.', 1)[0],
+                                                               backend=args.analyzer),
+                            to_analyze)
+                        for record, (analysis, call_ids) in zip(to_analyze, analyses):
+                            record['analysis'] = analysis
+                            record['call_ids'] = call_ids
+
+                stored += write_batch(conn, records)
+
+                for record in records:
+                    if 'error' in record:
+                        failed += 1
+                        print(f"  failed: {record['source_path']}: {record['error']['reason']}: "
+                              f"{record['error']['message']}", file=sys.stderr)
+                    else:
+                        pages += len(record['pages'])
+                    duplicates += 1 if record.get('duplicate') else 0
+                    bytes_read += record['size']
+
+                # Checkpoint only after the batch is committed
+                done.update(batch)
+                save_checkpoint(args.checkpoint, done)
+
+                processed += len(batch)
+                elapsed = max(time.monotonic() - started, 1e-6)
+                print(f"[{processed}/{total}] {processed / elapsed:.1f} files/s, {pages / elapsed:.1f} pages/s, "
+                      f"{bytes_read / elapsed / 1024 / 1024:.1f} MB/s | stored {stored}, "
+                      f"duplicates {duplicates}, failed {failed}")
+    except KeyboardInterrupt:
+        print("\nInterrupted; rerun with the same --checkpoint to resume")
+        sys.exit(130)
+    finally:
+        conn.close()
+
+    elapsed = time.monotonic() - started
+    print(f"Done: {stored} stored, {duplicates} duplicates, {failed} failed in {elapsed:.1f}s")
+    if args.analyzer == 'none' and stored:
+        print("Documents were stored with pending analysis; use /api/documents/<id>/regenerate to analyze them")
+    elif args.analyzer == 'local' and stored:
+        print("Documents were analyzed locally; use /api/documents/reanalyze for full AI analysis")
+
+if __name__ == '__main__':
+    main()
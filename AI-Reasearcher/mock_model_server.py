@@ -0,0 +1,267 @@
+"""Offline stand-in for the Anthropic Messages API, for load tests without network access
+
+Usage:
+    python mock_model_server.py [--port 8788] [--latency-ms 800] [--error-rate 0.02] [--cassette calls.jsonl]
+
+Point the research hub at it with environment variables, then upload or import as usual:
+
+    ANTHROPIC_BASE_URL=http://localhost:8788 ANTHROPIC_API_KEY=mock ANALYSIS_BATCH_BACKEND=local python app.py
+
+It answers POST /v1/messages (plain and streamed) and POST /v1/messages/count_tokens with canned analyses,
+after a latency drawn from a log-normal distribution, and injects overloaded (529), server (500) and rate limit
+(429) errors at the configured rates. Every random choice is seeded by the request content, so a run replays
+the same latencies and errors for the same documents regardless of arrival order.
+
+With --cassette, responses recorded in the JSONL file are replayed by request; add --record to forward requests
+missing from the cassette to the real API and append their responses.
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import Counter
+
+from flask import Flask, Response, jsonify, request
+
+UPSTREAM_URL = 'https://api.anthropic.com'
+MIN_CACHEABLE_TOKENS = 1024
+CHARS_PER_TOKEN = 4
+STREAM_CHUNK_CHARS = 16
+WORD_PATTERN = re.compile(r'[A-Za-z][A-Za-z-]{3,}')
+TITLE_PATTERN = re.compile(r'titled "([^"]*)"')
+ERRORS = {
+    529: ('overloaded_error', 'Overloaded'),
+    500: ('api_error', 'Internal server error'),
+    429: ('rate_limit_error', 'Number of request tokens has exceeded your per-minute rate limit')
+}
+
+app = Flask(__name__)
+options = None
+cassette = {}
+cassette_lock = threading.Lock()
+occurrences = Counter()
+cached_prefixes = set()
+stats = Counter()
+stats_lock = threading.Lock()
+
+def parse_args():
+    """Parse command-line options"""
+    parser = argparse.ArgumentParser(description='Mock Anthropic Messages API for offline load tests')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=8788, help='Port to listen on (default: %(default)s)')
+    parser.add_argument('--latency-ms', type=float, default=800,
+                        help='Median time to the first output token (default: %(default)s)')
+    parser.add_argument('--latency-sigma', type=float, default=0.5,
+                        help='Spread of the log-normal latency distribution; 0 for a fixed latency '
+                             '(default: %(default)s)')
+    parser.add_argument('--tokens-per-second', type=float, default=80,
+                        help='Output speed once the first token is sent (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Share of requests answered with a 529 or 500 error (default: %(default)s)')
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0,
+                        help='Share of requests answered with a 429 rate limit error (default: %(default)s)')
+    parser.add_argument('--retry-after', type=float, default=2,
+                        help='retry-after seconds sent with 429 responses (default: %(default)s)')
+    parser.add_argument('--seed', default='0', help='Seed mixed into every random choice (default: %(default)s)')
+    parser.add_argument('--cassette', help='JSONL file of recorded responses to replay')
+    parser.add_argument('--record', action='store_true',
+                        help='Forward requests missing from the cassette to the real API and record the responses')
+    return parser.parse_args()
+
+def request_key(body):
+    """Stable key of a request: what was asked, not how (streaming and token limits are ignored)"""
+    relevant = {'model': body.get('model'), 'system': body.get('system'), 'messages': body.get('messages')}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+def load_cassette(path):
+    """Read recorded {key, response} lines into the replay table"""
+    try:
+        with open(path) as cassette_file:
+            for line in cassette_file:
+                if line.strip():
+                    entry = json.loads(line)
+                    cassette[entry['key']] = entry['response']
+    except FileNotFoundError:
+        pass
+
+def text_of(content):
+    """Plain text of a system or message content field (a string or a list of blocks)"""
+    if isinstance(content, str):
+        return content
+    return ''.join(block.get('text', '') for block in content or [])
+
+def count_input_tokens(body):
+    """Approximate input tokens, split into (system prefix, the rest)"""
+    system = len(text_of(body.get('system'))) // CHARS_PER_TOKEN
+    messages = sum(len(text_of(message['content'])) for message in body.get('messages', [])) // CHARS_PER_TOKEN
+    return system, messages
+
+def canned_analysis(body):
+    """A plausible analysis built from the prompt itself: its title and most frequent words"""
+    prompt = ' '.join(text_of(message['content']) for message in body.get('messages', []))
+    title = TITLE_PATTERN.search(prompt)
+    words = Counter(word.lower() for word in WORD_PATTERN.findall(prompt))
+    keywords = [word for word, _ in words.most_common(8)]
+    return {
+        'summary': f'Mock analysis of "{title.group(1) if title else "document"}" ({len(prompt)} characters).',
+        'keywords': keywords[:5],
+        'entities': [word.title() for word in keywords[5:8]],
+        'topic': keywords[0].title() if keywords else 'General'
+    }
+
+def marked_for_caching(system):
+    """Whether a system field carries a cache_control breakpoint"""
+    return isinstance(system, list) and any('cache_control' in block for block in system)
+
+def build_message(body, text):
+    """A Messages API response carrying `text`, with usage that mimics prompt caching of a marked system prefix"""
+    system_tokens, message_tokens = count_input_tokens(body)
+    cache_creation = cache_read = 0
+    if marked_for_caching(body.get('system')) and system_tokens >= MIN_CACHEABLE_TOKENS:
+        prefix = hashlib.sha256(text_of(body.get('system')).encode()).hexdigest()
+        with cassette_lock:
+            if prefix in cached_prefixes:
+                cache_read = system_tokens
+            else:
+                cached_prefixes.add(prefix)
+                cache_creation = system_tokens
+    return {
+        'id': 'msg_mock_' + uuid.uuid4().hex[:24],
+        'type': 'message',
+        'role': 'assistant',
+        'model': body.get('model'),
+        'content': [{'type': 'text', 'text': text}],
+        'stop_reason': 'end_turn',
+        'stop_sequence': None,
+        'usage': {
+            'input_tokens': message_tokens + (0 if cache_creation or cache_read else system_tokens),
+            'output_tokens': max(len(text) // CHARS_PER_TOKEN, 1),
+            'cache_creation_input_tokens': cache_creation,
+            'cache_read_input_tokens': cache_read
+        }
+    }
+
+def forward_upstream(body):
+    """Send a non-streamed copy of the request to the real API and return its response"""
+    upstream_body = {key: value for key, value in body.items() if key != 'stream'}
+    upstream = urllib.request.Request(
+        f'{UPSTREAM_URL}/v1/messages', data=json.dumps(upstream_body).encode(), method='POST',
+        headers={
+            'content-type': 'application/json',
+            'x-api-key': request.headers.get('x-api-key', ''),
+            'anthropic-version': request.headers.get('anthropic-version', '2023-06-01')
+        })
+    with urllib.request.urlopen(upstream, timeout=600) as response:
+        return json.loads(response.read())
+
+def record_response(key, message):
+    """Append a response to the cassette file and the replay table"""
+    with cassette_lock:
+        cassette[key] = message
+        with open(options.cassette, 'a') as cassette_file:
+            cassette_file.write(json.dumps({'key': key, 'response': message}) + '\n')
+
+def error_response(status):
+    error_type, message = ERRORS[status]
+    response = jsonify({'type': 'error', 'error': {'type': error_type, 'message': message}})
+    response.status_code = status
+    if status == 429:
+        response.headers['retry-after'] = str(options.retry_after)
+    return response
+
+def stream_message(message, rng):
+    """Server-sent events in the Messages streaming format, paced at --tokens-per-second"""
+    text = message['content'][0]['text']
+    delay = STREAM_CHUNK_CHARS / CHARS_PER_TOKEN / options.tokens_per_second
+    started = {**message, 'content': [], 'stop_reason': None,
+               'usage': {**message['usage'], 'output_tokens': 1}}
+
+    def event(name, data):
+        return f'event: {name}\ndata: {json.dumps({"type": name, **data})}\n\n'
+
+    yield event('message_start', {'message': started})
+    yield event('content_block_start', {'index': 0, 'content_block': {'type': 'text', 'text': ''}})
+    for start in range(0, len(text), STREAM_CHUNK_CHARS):
+        time.sleep(delay * rng.uniform(0.5, 1.5))
+        yield event('content_block_delta', {'index': 0,
+                                            'delta': {'type': 'text_delta', 'text': text[start:start + STREAM_CHUNK_CHARS]}})
+    yield event('content_block_stop', {'index': 0})
+    yield event('message_delta', {'delta': {'stop_reason': 'end_turn', 'stop_sequence': None},
+                                  'usage': {'output_tokens': message['usage']['output_tokens']}})
+    yield event('message_stop', {})
+
+@app.route('/v1/messages', methods=['POST'])
+def create_message():
+    body = request.get_json()
+    key = request_key(body)
+
+    # Seed by request and how often it was seen, so outcomes do not depend on arrival order
+    with stats_lock:
+        occurrence = occurrences[key]
+        occurrences[key] += 1
+    rng = random.Random(f'{options.seed}:{key}:{occurrence}')
+
+    latency = options.latency_ms / 1000 * math.exp(rng.gauss(0, options.latency_sigma))
+    roll = rng.random()
+    if roll < options.rate_limit_rate:
+        with stats_lock:
+            stats['rate_limited'] += 1
+        return error_response(429)
+    if roll < options.rate_limit_rate + options.error_rate:
+        time.sleep(latency)
+        with stats_lock:
+            stats['errors'] += 1
+        return error_response(rng.choice([529, 500]))
+
+    if key in cassette:
+        message = {**cassette[key], 'id': 'msg_mock_' + uuid.uuid4().hex[:24]}
+        source = 'replayed'
+    elif options.record:
+        try:
+            message = forward_upstream(body)
+        except urllib.error.HTTPError as e:
+            return Response(e.read(), status=e.code, content_type='application/json')
+        record_response(key, message)
+        source = 'recorded'
+    else:
+        message = build_message(body, json.dumps(canned_analysis(body)))
+        source = 'canned'
+    with stats_lock:
+        stats[source] += 1
+        stats['output_tokens'] += message['usage']['output_tokens']
+
+    if body.get('stream'):
+        time.sleep(latency)
+        return Response(stream_message(message, rng), mimetype='text/event-stream')
+    time.sleep(latency + message['usage']['output_tokens'] / options.tokens_per_second)
+    return jsonify(message)
+
+@app.route('/v1/messages/count_tokens', methods=['POST'])
+def count_tokens():
+    return jsonify({'input_tokens': sum(count_input_tokens(request.get_json()))})
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    """Request outcomes so far: canned/replayed/recorded answers, injected errors and rate limits"""
+    with stats_lock:
+        return jsonify(dict(stats))
+
+def main():
+    global options
+    options = parse_args()
+    if options.record and not options.cassette:
+        raise SystemExit('--record needs --cassette')
+    if options.cassette:
+        load_cassette(options.cassette)
+        print(f"Loaded {len(cassette)} recorded responses from {options.cassette}")
+    app.run(host=options.host, port=options.port, threaded=True)
+
+if __name__ == '__main__':
+    main()
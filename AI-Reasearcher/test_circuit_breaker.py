@@ -0,0 +1,145 @@
+"""Circuit breaker state transitions, alone and as driven by AnalysisService.create
+
+Run with: python -m unittest test_circuit_breaker
+"""
+import asyncio
+import os
+import unittest
+from types import SimpleNamespace
+
+os.environ.setdefault('ANTHROPIC_API_KEY', 'test')
+
+import anthropic
+
+import app
+
+
+def api_error(error_class, status_code, headers=None):
+    """An SDK status error without going through an HTTP response"""
+    error = error_class.__new__(error_class)
+    error.status_code = status_code
+    error.response = SimpleNamespace(headers=headers or {})
+    return error
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.closed = []
+        self.breaker = app.CircuitBreaker(threshold=2, reset_seconds=60, on_close=lambda: self.closed.append(True))
+
+    def open_circuit(self):
+        for _ in range(2):
+            self.breaker.before_call()
+            self.breaker.record_failure()
+
+    def test_opens_after_threshold_consecutive_failures(self):
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        with self.assertRaises(app.CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_success_resets_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertEqual(self.closed, [])
+
+    def test_half_open_lets_one_probe_through(self):
+        self.open_circuit()
+        self.breaker.opened_at -= 60
+        self.assertTrue(self.breaker.before_call())
+        self.assertEqual(self.breaker.state, 'half_open')
+        with self.assertRaises(app.CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_probe_success_closes_and_runs_on_close(self):
+        self.open_circuit()
+        self.breaker.opened_at -= 60
+        self.breaker.before_call()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertEqual(self.closed, [True])
+        self.assertFalse(self.breaker.before_call())
+
+    def test_probe_failure_reopens(self):
+        self.open_circuit()
+        self.breaker.opened_at -= 60
+        self.breaker.before_call()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        with self.assertRaises(app.CircuitOpenError):
+            self.breaker.before_call()
+
+    def test_ended_probe_without_verdict_lets_next_call_probe(self):
+        self.open_circuit()
+        self.breaker.opened_at -= 60
+        self.breaker.before_call()
+        self.breaker.end_probe()
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.assertTrue(self.breaker.before_call())
+
+
+class AnalysisServiceProbeTest(unittest.TestCase):
+    """The probe must always release the half-open state, whatever the call's outcome"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.service = app.AnalysisService()
+
+    def setUp(self):
+        self.service.breaker = app.CircuitBreaker(threshold=1, reset_seconds=60)
+        self.service.request_bucket = app.TokenBucket(10000)
+        self.service.token_bucket = app.TokenBucket(10 ** 9)
+
+    def half_open(self):
+        self.service.breaker.before_call()
+        self.service.breaker.record_failure()
+        self.service.breaker.opened_at -= 60
+
+    def create(self, *outcomes):
+        """Run create() with send() answering each outcome in turn (exceptions are raised)"""
+        calls = iter(outcomes)
+
+        async def send(request_kwargs, on_text):
+            outcome = next(calls)
+            if isinstance(outcome, Exception):
+                raise outcome
+            return outcome
+
+        self.service.send = send
+        request_kwargs = {'model': app.ANALYSIS_MODEL, 'max_tokens': 10, 'messages': [{'role': 'user', 'content': 'x'}]}
+        return asyncio.run_coroutine_threadsafe(self.service.create(request_kwargs, record=False),
+                                                self.service.loop).result(timeout=10)
+
+    def test_non_transient_probe_error_closes_circuit(self):
+        self.half_open()
+        with self.assertRaises(anthropic.BadRequestError):
+            self.create(api_error(anthropic.BadRequestError, 400))
+        self.assertEqual(self.service.breaker.state, 'closed')
+        self.assertEqual(self.create(SimpleNamespace(usage=None)).usage, None)
+
+    def test_rate_limited_probe_is_retried_as_probe(self):
+        self.half_open()
+        message = SimpleNamespace(usage=None)
+        self.assertIs(self.create(api_error(anthropic.RateLimitError, 429, {'retry-after': '0'}), message), message)
+        self.assertEqual(self.service.breaker.state, 'closed')
+
+    def test_transient_probe_failure_reopens(self):
+        self.half_open()
+        app_max_retries, app.ANALYSIS_MAX_RETRIES = app.ANALYSIS_MAX_RETRIES, 0
+        try:
+            with self.assertRaises(anthropic.InternalServerError):
+                self.create(api_error(anthropic.InternalServerError, 500))
+        finally:
+            app.ANALYSIS_MAX_RETRIES = app_max_retries
+        self.assertEqual(self.service.breaker.state, 'open')
+        self.assertFalse(self.service.breaker.probing)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+"""Section sampling of long documents within the analysis token budget
+
+Run with: python -m unittest test_section_sampling
+"""
+import os
+import unittest
+
+os.environ.setdefault('ANTHROPIC_API_KEY', 'test')
+
+import app
+
+SENTENCE = 'Learned models generalize when the training data covers the deployment distribution. '
+
+
+def paper(pages, running_header='JOURNAL OF MACHINE LEARNING RESEARCH'):
+    """A structured paper whose every page starts with the same running header"""
+    page = f'{running_header}\n{SENTENCE * 30}\n'
+    return (f'Abstract\n{SENTENCE * 4}\n1. Introduction\n{page * pages}\n'
+            f'5. Conclusion\n{SENTENCE * 5}\nReferences\n[1] A. Author. A paper. 2020.\n')
+
+
+class SampleSectionsTest(unittest.TestCase):
+    def test_short_text_is_sent_whole(self):
+        text = paper(1)
+        self.assertEqual(app.sample_sections(text, len(text)), text)
+
+    def test_sample_stays_within_budget(self):
+        text = paper(300)
+        for budget_tokens in (1250, 100, 5):
+            with self.subTest(budget_tokens=budget_tokens):
+                self.assertLessEqual(len(app.sample_sections(text, budget_tokens)),
+                                     budget_tokens * app.CHARS_PER_TOKEN)
+
+    def test_running_headers_are_not_sections(self):
+        sample = app.sample_sections(paper(300), 1250)
+        self.assertNotIn('JOURNAL OF MACHINE LEARNING RESEARCH', sample)
+        self.assertIn('[Abstract]', sample)
+        self.assertIn('[1. Introduction]', sample)
+        self.assertIn('[5. Conclusion]', sample)
+        self.assertNotIn('[References]', sample)
+
+    def test_many_headings_stay_within_budget(self):
+        text = ''.join(f'\n{i}. Section Number {i}\n{SENTENCE * 3}' for i in range(1, 400))
+        self.assertLessEqual(len(app.sample_sections(text, 100)), 100 * app.CHARS_PER_TOKEN)
+
+    def test_leading_span_of_nothing_is_empty(self):
+        self.assertEqual(app.leading_span(SENTENCE, 0), '')
+        self.assertEqual(app.leading_span(SENTENCE, -10), '')
+
+
+class BudgetedRequestTest(unittest.TestCase):
+    def test_request_stays_within_budget(self):
+        text = paper(300)
+        request_kwargs = app.budgeted_analysis_request(text, app.sample_sections(text, app.ANALYSIS_INPUT_TOKENS),
+                                                       'Paper')
+        limit = app.ANALYSIS_INPUT_TOKENS + app.ANALYSIS_PROMPT_OVERHEAD_TOKENS
+        self.assertLessEqual(app.request_chars(request_kwargs) // app.CHARS_PER_TOKEN, limit)
+
+
+if __name__ == '__main__':
+    unittest.main()